@@ -4,8 +4,44 @@ Maintains conversation history and sends messages to the LLM.
 Uses a system prompt tuned for tutoring.
 """
 
-from utils.config import chat_completion, get_client, get_model
+from utils.config import (
+    chat_completion,
+    achat_completion,
+    stream_chat_completion,
+    get_client,
+    get_input_budget,
+    get_model,
+)
 from utils.prompts import CHAT_SYSTEM
+from utils.telemetry import span
+from utils.tokens import count_message_tokens, truncate_to_tokens
+
+# Completion room reserved for the tutor's reply
+REPLY_TOKENS = 1024
+# Upper bound on study material injected per turn (it is resent every turn)
+MAX_CONTEXT_TOKENS = 8000
+
+
+def _build_messages(
+    conversation_history: list[dict],
+    user_message: str,
+    study_context: str,
+) -> list[dict]:
+    context_intro = "\n\nThe student has provided the following study material for context:\n\n"
+
+    messages = [{"role": "system", "content": CHAT_SYSTEM + context_intro}]
+    messages.extend(conversation_history)
+    messages.append({"role": "user", "content": user_message})
+
+    if study_context.strip():
+        # Give the study material whatever the conversation leaves of the budget
+        used = count_message_tokens(messages, get_model())
+        room = min(MAX_CONTEXT_TOKENS, get_input_budget(REPLY_TOKENS) - used)
+        context = truncate_to_tokens(study_context, room, get_model())
+        messages[0]["content"] = CHAT_SYSTEM + context_intro + context
+    else:
+        messages[0]["content"] = CHAT_SYSTEM
+    return messages
 
 
 def get_ai_response(
@@ -24,15 +60,34 @@ def get_ai_response(
     Returns:
         The assistant's reply as a markdown string.
     """
-    system_prompt = CHAT_SYSTEM
-    if study_context.strip():
-        system_prompt += f"\n\nThe student has provided the following study material for context:\n\n{study_context[:3000]}"
+    with span("chat", feature="chat", turns=len(conversation_history)):
+        messages = _build_messages(conversation_history, user_message, study_context)
+        return chat_completion(messages, temperature=0.7)
 
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(conversation_history)
-    messages.append({"role": "user", "content": user_message})
 
-    return chat_completion(messages, temperature=0.7)
+async def aget_ai_response(
+    conversation_history: list[dict],
+    user_message: str,
+    study_context: str = "",
+) -> str:
+    """Async version of get_ai_response()."""
+    with span("chat", feature="chat", turns=len(conversation_history)):
+        messages = _build_messages(conversation_history, user_message, study_context)
+        return await achat_completion(messages, temperature=0.7)
+
+
+def get_ai_response_stream(
+    conversation_history: list[dict],
+    user_message: str,
+    study_context: str = "",
+):
+    """
+    Streaming version of get_ai_response(): yields the reply piece by
+    piece as the model generates it (e.g. for st.write_stream).
+    """
+    with span("chat", feature="chat", turns=len(conversation_history), stream=True):
+        messages = _build_messages(conversation_history, user_message, study_context)
+        yield from stream_chat_completion(messages, temperature=0.7)
 
 
 def build_history(messages: list[dict]) -> list[dict]:
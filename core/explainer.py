@@ -3,8 +3,9 @@ Core module: Concept Explainer
 Explains any topic at a specified difficulty level using an LLM.
 """
 
-from utils.config import chat_completion
+from utils.config import chat_completion, achat_completion, stream_chat_completion
 from utils.prompts import EXPLAINER_SYSTEM, explainer_user_prompt
+from utils.telemetry import span
 
 
 DIFFICULTY_LEVELS = {
@@ -15,6 +16,18 @@ DIFFICULTY_LEVELS = {
 }
 
 
+def _build_messages(topic: str, level: str, extra_context: str) -> list[dict]:
+    if not topic.strip():
+        raise ValueError("Topic cannot be empty.")
+
+    level_description = DIFFICULTY_LEVELS.get(level, level)
+
+    return [
+        {"role": "system", "content": EXPLAINER_SYSTEM},
+        {"role": "user", "content": explainer_user_prompt(topic, level_description, extra_context)},
+    ]
+
+
 def explain_concept(topic: str, level: str, extra_context: str = "") -> str:
     """
     Generate an explanation of `topic` at the given difficulty `level`.
@@ -27,14 +40,23 @@ def explain_concept(topic: str, level: str, extra_context: str = "") -> str:
     Returns:
         A formatted explanation string (markdown)
     """
-    if not topic.strip():
-        raise ValueError("Topic cannot be empty.")
+    with span("explain", feature="explainer", level=level):
+        messages = _build_messages(topic, level, extra_context)
+        return chat_completion(messages, temperature=0.7)
 
-    level_description = DIFFICULTY_LEVELS.get(level, level)
 
-    messages = [
-        {"role": "system", "content": EXPLAINER_SYSTEM},
-        {"role": "user", "content": explainer_user_prompt(topic, level_description, extra_context)},
-    ]
+async def aexplain_concept(topic: str, level: str, extra_context: str = "") -> str:
+    """Async version of explain_concept()."""
+    with span("explain", feature="explainer", level=level):
+        messages = _build_messages(topic, level, extra_context)
+        return await achat_completion(messages, temperature=0.7)
+
 
-    return chat_completion(messages, temperature=0.7)
+def explain_concept_stream(topic: str, level: str, extra_context: str = ""):
+    """
+    Streaming version of explain_concept(): yields the explanation
+    piece by piece as the model generates it (e.g. for st.write_stream).
+    """
+    with span("explain", feature="explainer", level=level, stream=True):
+        messages = _build_messages(topic, level, extra_context)
+        yield from stream_chat_completion(messages, temperature=0.7)
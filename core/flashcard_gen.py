@@ -4,76 +4,183 @@ Generates term-definition flashcard pairs from any topic or notes.
 Also provides export to CSV (Anki-compatible).
 """
 
-import json
-import re
 import io
 import csv
-from utils.config import chat_completion
+from typing import Iterator
+from utils.config import chat_completion, achat_completion, get_input_budget, get_model, stream_chat_completion
+from utils.extractive import FAST_MODE_TOKENS, compress
+from utils.json_stream import JSONArrayStream, salvage_json_array
+from utils.pdf_reader import remove_boilerplate
 from utils.prompts import FLASHCARD_SYSTEM, flashcard_user_prompt
+from utils.telemetry import span
+from utils.tokens import count_message_tokens, truncate_to_tokens
 
+# Completion tokens reserved per generated card
+TOKENS_PER_CARD = 80
 
-def _clean_json(raw: str) -> str:
-    """Strip markdown code fences from raw LLM response."""
-    raw = raw.strip()
-    raw = re.sub(r"^```(?:json)?\s*", "", raw)
-    raw = re.sub(r"\s*```$", "", raw)
-    return raw.strip()
+
+def _build_messages(topic_or_notes: str, num_cards: int, fast: bool = False, exclude: list[str] = ()) -> list[dict]:
+    if not topic_or_notes.strip():
+        raise ValueError("Topic or notes cannot be empty.")
+    # Repeated headers/footers and duplicate pages only cost prompt tokens
+    topic_or_notes, _ = remove_boilerplate(topic_or_notes, get_model())
+
+    num_cards = max(1, min(30, num_cards))  # clamp 1-30
+
+    def build(content):
+        return [
+            {"role": "system", "content": FLASHCARD_SYSTEM},
+            {"role": "user", "content": flashcard_user_prompt(content, num_cards, exclude)},
+        ]
+
+    # Trim long notes so the prompt plus the expected JSON fit the model's budget
+    overhead = count_message_tokens(build(""), get_model())
+    room = get_input_budget(num_cards * TOKENS_PER_CARD) - overhead
+    if fast:
+        # Keep the most informative sentences instead of just the beginning
+        topic_or_notes = compress(topic_or_notes, min(room, FAST_MODE_TOKENS), get_model())
+    return build(truncate_to_tokens(topic_or_notes, room, get_model()))
+
+
+def _valid_card(item):
+    """`item` as a card dict, or None if it lacks a non-empty front and back."""
+    if not isinstance(item, dict):
+        return None
+    front, back = str(item.get("front") or "").strip(), str(item.get("back") or "").strip()
+    if not front or not back:
+        return None
+    return {"front": front, "back": back, "category": str(item.get("category") or "General")}
+
+
+def _parse_cards(raw: str) -> tuple[list[dict], int]:
+    """
+    Every valid card in a reply, even a truncated or partly malformed one,
+    and the number of entries that had to be dropped.
+    """
+    items, broken = salvage_json_array(raw)
+    cards = [card for card in map(_valid_card, items) if card]
+    return cards, broken + len(items) - len(cards)
+
+
+def _add_cards(deck: list[dict], cards: list[dict], limit: int) -> list[dict]:
+    """Append cards whose front is not in `deck` yet, up to `limit`; returns those added."""
+    fronts = {card["front"].casefold() for card in deck}
+    added = []
+    for card in cards:
+        if len(deck) >= limit:
+            break
+        if card["front"].casefold() not in fronts:
+            fronts.add(card["front"].casefold())
+            deck.append(card)
+            added.append(card)
+    return added
+
+
+def _top_up_messages(topic_or_notes: str, deck: list[dict], num_cards: int, fast: bool) -> list[dict]:
+    """Messages asking only for the cards still missing, listing the existing fronts."""
+    return _build_messages(topic_or_notes, num_cards - len(deck), fast, [card["front"] for card in deck])
+
+
+def _report(deck: list[dict], rejected: int, topped_up: bool, current) -> list[dict]:
+    current.set(rejected=rejected, top_ups=int(topped_up), generated=len(deck))
+    if not deck:
+        raise ValueError("Could not parse any valid flashcards from the model response.")
+    return deck
 
 
 def generate_flashcards(
     topic_or_notes: str,
     num_cards: int = 10,
+    fast: bool = False,
 ) -> list[dict]:
     """
     Generate flashcards as a list of dicts with 'front', 'back', 'category'.
 
+    Valid cards are kept even when the reply is truncated or has bad
+    entries; one follow-up request asks only for the cards still missing.
+
     Args:
         topic_or_notes: A topic name (e.g., "Photosynthesis") or raw study notes
         num_cards: Number of flashcards to generate (1-30)
+        fast: Condense long notes locally (extractive) before prompting
 
     Returns:
         List of dicts: [{"front": str, "back": str, "category": str}, ...]
 
     Raises:
-        ValueError: If the model response cannot be parsed.
+        ValueError: If no valid card could be recovered from the model's replies.
     """
-    if not topic_or_notes.strip():
-        raise ValueError("Topic or notes cannot be empty.")
-
-    num_cards = max(1, min(30, num_cards))  # clamp 1-30
-
-    messages = [
-        {"role": "system", "content": FLASHCARD_SYSTEM},
-        {"role": "user", "content": flashcard_user_prompt(topic_or_notes, num_cards)},
-    ]
-
-    raw = chat_completion(messages, temperature=0.6)
-    cleaned = _clean_json(raw)
-
-    try:
-        cards = json.loads(cleaned)
-    except json.JSONDecodeError:
-        match = re.search(r"\[.*\]", cleaned, re.DOTALL)
-        if match:
-            cards = json.loads(match.group())
-        else:
-            raise ValueError(
-                f"Could not parse flashcard JSON from model response.\nRaw:\n{raw}"
-            )
-
-    if not isinstance(cards, list):
-        raise ValueError("Expected a JSON array of flashcards.")
-
-    # Ensure all cards have the required keys
-    normalized = []
-    for card in cards:
-        normalized.append({
-            "front": card.get("front", ""),
-            "back": card.get("back", ""),
-            "category": card.get("category", "General"),
-        })
+    with span("flashcards.generate", feature="flashcards", requested=num_cards, fast=fast) as current:
+        num_cards = max(1, min(30, num_cards))  # clamp 1-30
+        deck, rejected = [], 0
+        messages = _build_messages(topic_or_notes, num_cards, fast)
+        for top_up in (False, True):
+            # A top-up must not be answered with the cached reply that came up short
+            raw = chat_completion(messages, temperature=0.6, use_cache=not top_up)
+            with span("flashcards.parse") as parsed:
+                cards, dropped = _parse_cards(raw)
+                parsed.set(valid=len(cards), rejected=dropped)
+            rejected += dropped
+            _add_cards(deck, cards, num_cards)
+            if len(deck) >= num_cards:
+                break
+            messages = _top_up_messages(topic_or_notes, deck, num_cards, fast)
+        return _report(deck, rejected, top_up, current)
+
+
+async def agenerate_flashcards(
+    topic_or_notes: str,
+    num_cards: int = 10,
+    fast: bool = False,
+) -> list[dict]:
+    """Async version of generate_flashcards()."""
+    with span("flashcards.generate", feature="flashcards", requested=num_cards, fast=fast) as current:
+        num_cards = max(1, min(30, num_cards))  # clamp 1-30
+        deck, rejected = [], 0
+        messages = _build_messages(topic_or_notes, num_cards, fast)
+        for top_up in (False, True):
+            raw = await achat_completion(messages, temperature=0.6, use_cache=not top_up)
+            with span("flashcards.parse") as parsed:
+                cards, dropped = _parse_cards(raw)
+                parsed.set(valid=len(cards), rejected=dropped)
+            rejected += dropped
+            _add_cards(deck, cards, num_cards)
+            if len(deck) >= num_cards:
+                break
+            messages = _top_up_messages(topic_or_notes, deck, num_cards, fast)
+        return _report(deck, rejected, top_up, current)
+
+
+def generate_flashcards_stream(
+    topic_or_notes: str,
+    num_cards: int = 10,
+    fast: bool = False,
+) -> Iterator[dict]:
+    """
+    Streaming version of generate_flashcards(): yields each card dict as
+    soon as the model has finished writing it. Malformed entries are
+    skipped and the missing cards streamed from one follow-up request.
 
-    return normalized
+    Raises:
+        ValueError: If no valid card could be recovered from the model's replies.
+    """
+    with span("flashcards.generate", feature="flashcards", requested=num_cards, fast=fast, stream=True) as current:
+        num_cards = max(1, min(30, num_cards))  # clamp 1-30
+        deck, rejected = [], 0
+        messages = _build_messages(topic_or_notes, num_cards, fast)
+        for top_up in (False, True):
+            parser = JSONArrayStream(strict=False)
+            for delta in stream_chat_completion(messages, temperature=0.6, use_cache=not top_up):
+                for item in parser.feed(delta):
+                    card = _valid_card(item)
+                    rejected += card is None
+                    yield from _add_cards(deck, [card] if card else [], num_cards)
+            parser.close()
+            rejected += parser.skipped
+            if len(deck) >= num_cards:
+                break
+            messages = _top_up_messages(topic_or_notes, deck, num_cards, fast)
+        _report(deck, rejected, top_up, current)
 
 
 def export_flashcards_csv(cards: list[dict]) -> bytes:
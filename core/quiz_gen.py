@@ -4,36 +4,359 @@ Generates MCQ or True/False quizzes from any topic or notes.
 Returns structured JSON that the UI layer renders interactively.
 """
 
-import json
+import asyncio
+import contextvars
+import queue
 import re
-from utils.config import chat_completion
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+from utils.config import (
+    chat_completion,
+    achat_completion,
+    get_input_budget,
+    get_map_concurrency,
+    get_model,
+    stream_chat_completion,
+)
+from utils.extractive import FAST_MODE_TOKENS, compress
+from utils.json_stream import JSONArrayStream, salvage_json_array
+from utils.pdf_reader import chunk_spans, remove_boilerplate
 from utils.prompts import QUIZ_SYSTEM, quiz_user_prompt
+from utils.telemetry import span
+from utils.tokens import count_message_tokens, count_tokens, count_tokens_batch, truncate_to_tokens
+
+# Completion tokens reserved per generated question
+TOKENS_PER_QUESTION = 150
+# Notes are split into one section per this many tokens (at most one per question)
+SHARD_MIN_TOKENS = 1500
+# Upper bound on sections questioned in parallel
+MAX_QUIZ_SHARDS = 8
+# Word overlap (Jaccard, question plus answer) at which two questions count as the same
+DUPLICATE_QUESTION_SIMILARITY = 0.75
+# Options every MCQ question must have
+MCQ_OPTIONS = 4
+
+# "A) ...", "(b) ...", "C. ..." option labels
+_OPTION_LABEL = re.compile(r"^\s*\(?([A-Za-z])[).:]\s*")
+
+
+def _build_messages(
+    topic_or_notes: str,
+    num_questions: int,
+    quiz_type: str,
+    fast: bool = False,
+    exclude: list[str] = (),
+) -> list[dict]:
+    if not topic_or_notes.strip():
+        raise ValueError("Topic or notes cannot be empty.")
+    # Repeated headers/footers and duplicate pages only cost prompt tokens
+    topic_or_notes, _ = remove_boilerplate(topic_or_notes, get_model())
+
+    num_questions = max(1, min(20, num_questions))  # clamp to 1-20
+
+    def build(content):
+        return [
+            {"role": "system", "content": QUIZ_SYSTEM},
+            {"role": "user", "content": quiz_user_prompt(content, num_questions, quiz_type, exclude)},
+        ]
+
+    # Trim long notes so the prompt plus the expected JSON fit the model's budget
+    overhead = count_message_tokens(build(""), get_model())
+    room = get_input_budget(num_questions * TOKENS_PER_QUESTION) - overhead
+    if fast:
+        # Keep the most informative sentences instead of just the beginning
+        topic_or_notes = compress(topic_or_notes, min(room, FAST_MODE_TOKENS), get_model())
+    return build(truncate_to_tokens(topic_or_notes, room, get_model()))
+
+
+def _match_option(answer, options: list[str]):
+    """The option `answer` refers to: the option itself, its letter ("B") or its text without the label."""
+    if not isinstance(answer, str) or not answer.strip():
+        return None
+    answer = answer.strip()
+    letter = answer.rstrip(").:").strip().upper()
+    text = _OPTION_LABEL.sub("", answer, count=1).strip().lower()
+    for option in options:
+        label = _OPTION_LABEL.match(option)
+        if option.strip() == answer or (len(letter) == 1 and label and label.group(1).upper() == letter):
+            return option
+    for option in options:
+        if _OPTION_LABEL.sub("", option, count=1).strip().lower() == text:
+            return option
+    return None
+
+
+def _valid_question(item, quiz_type: str):
+    """
+    `item` as a well-formed question dict, or None if it does not fit the
+    schema: MCQ needs MCQ_OPTIONS options and an answer that is one of
+    them, True/False an answer of True or False.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get("question"), str) or not item["question"].strip():
+        return None
+    question = {"question": item["question"].strip()}
+
+    if quiz_type == "MCQ":
+        options = item.get("options")
+        if not isinstance(options, list) or len(options) != MCQ_OPTIONS:
+            return None
+        if not all(isinstance(option, str) and option.strip() for option in options):
+            return None
+        answer = _match_option(item.get("answer"), options)
+        if answer is None:
+            return None
+        question.update(options=options, answer=answer)
+    else:
+        answer = {"true": "True", "false": "False"}.get(str(item.get("answer", "")).strip().lower())
+        if answer is None:
+            return None
+        question["answer"] = answer
+
+    question["explanation"] = str(item.get("explanation") or "")
+    return question
+
+
+def _parse_questions(raw: str, quiz_type: str = "MCQ") -> tuple[list[dict], int]:
+    """
+    Every valid question in a reply, even a truncated or partly malformed
+    one, and the number of entries that had to be dropped.
+    """
+    items, broken = salvage_json_array(raw)
+    questions = [q for q in (_valid_question(item, quiz_type) for item in items) if q]
+    return questions, broken + len(items) - len(questions)
+
+
+# ─────────────────────────────────────────────
+# SHARDED GENERATION (long notes)
+# ─────────────────────────────────────────────
+
+_WORD = re.compile(r"\w+")
+
+
+def _allocate(weights: list[int], total: int) -> list[int]:
+    """Split `total` into integer shares proportional to `weights` (largest remainder)."""
+    quotas = [total * w / sum(weights) for w in weights]
+    counts = [int(q) for q in quotas]
+    by_remainder = sorted(range(len(weights)), key=lambda i: counts[i] - quotas[i])
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def _plan_shards(notes: str, num_questions: int) -> list[tuple[str, int]]:
+    """
+    Split long notes into contiguous sections of similar size and give each
+    a share of the questions proportional to its length. Returns
+    (section, question count) pairs; a single pair when the notes are too
+    short for sharding to pay off.
+    """
+    model = get_model()
+    total = count_tokens(notes, model)
+    shards = min(num_questions, MAX_QUIZ_SHARDS, total // SHARD_MIN_TOKENS)
+    if shards < 2:
+        return [(notes, num_questions)]
+
+    # Structural chunks of about 1/shards of the notes, regrouped into exactly `shards` sections
+    spans = chunk_spans(notes, max_tokens=-(-total // shards), overlap=0, model=model)
+    sizes = count_tokens_batch([notes[start:end] for start, end in spans], model)
+    groups, seen, measured = [], 0, max(1, sum(sizes))
+    for (start, end), size in zip(spans, sizes):
+        group = min(shards - 1, (seen + size // 2) * shards // measured)
+        seen += size
+        if groups and groups[-1][0] == group:
+            groups[-1][2] = end
+            groups[-1][3] += size
+        else:
+            groups.append([group, start, end, size])
+
+    counts = _allocate([size for *_, size in groups], num_questions)
+    return [(notes[start:end], count) for (_, start, end, _), count in zip(groups, counts) if count]
+
+
+def _question_words(question) -> frozenset:
+    """Words of a question and its answer: the answer keeps "capital of France?" apart from "...Spain?"."""
+    if not isinstance(question, dict) or not str(question.get("question", "")).strip():
+        return frozenset()
+    return frozenset(_WORD.findall(f"{question['question']} {question.get('answer', '')}".lower()))
+
+
+class _QuizSections:
+    """
+    Collects the questions generated for each section: drops near-duplicates,
+    keeps each section to its share and tracks how many are still missing.
+    A topic or short notes are a single section.
+    """
 
+    def __init__(self, sections: list[tuple[str, int]]):
+        self.sections = sections
+        self.kept = [[] for _ in sections]
+        self.spare = []  # questions beyond a section's share, used before asking again
+        self.seen = []
+        self.duplicates = 0
+        self.rejected = 0  # entries dropped as malformed or off-schema
+        self.top_ups = 0
 
-def _clean_json(raw: str) -> str:
+    def add(self, index: int, questions: list[dict]) -> list[dict]:
+        """Add valid questions for section `index`; returns those that joined it."""
+        added = []
+        for question in questions:
+            words = _question_words(question)
+            if not words:
+                continue
+            if any(len(words & other) / len(words | other) >= DUPLICATE_QUESTION_SIMILARITY for other in self.seen):
+                self.duplicates += 1
+                continue
+            self.seen.append(words)
+            if len(self.kept[index]) < self.sections[index][1]:
+                self.kept[index].append(question)
+                added.append(question)
+            else:
+                self.spare.append(question)
+        return added
+
+    def shortfall(self) -> list[tuple[int, int]]:
+        """
+        Move spare questions into sections below their share, then return
+        (section index, missing count) for the sections still short.
+        """
+        missing = []
+        for i, (_, count) in enumerate(self.sections):
+            while len(self.kept[i]) < count and self.spare:
+                self.kept[i].append(self.spare.pop(0))
+            if len(self.kept[i]) < count:
+                missing.append((i, count - len(self.kept[i])))
+        return missing
+
+    def exclude(self, index: int) -> list[str]:
+        return [q["question"] for q in self.kept[index]]
+
+    def questions(self) -> list[dict]:
+        return [q for section in self.kept for q in section]
+
+    def report(self, current) -> list[dict]:
+        """Record the outcome on the `current` span and return the questions."""
+        questions = self.questions()
+        current.set(
+            shards=len(self.sections),
+            duplicates=self.duplicates,
+            rejected=self.rejected,
+            top_ups=self.top_ups,
+            generated=len(questions),
+        )
+        if not questions:
+            raise ValueError("Could not parse any valid quiz questions from the model response.")
+        return questions
+
+
+def _section_tasks(quiz: _QuizSections, requests: list[tuple[int, int]], quiz_type: str, fast: bool, top_up: bool):
+    """(section index, messages) per request, top-ups listing the section's existing questions."""
+    return [
+        (i, _build_messages(quiz.sections[i][0], count, quiz_type, fast, quiz.exclude(i) if top_up else ()))
+        for i, count in requests
+    ]
+
+
+def _collect(quiz: _QuizSections, indexes: list[int], results: list, quiz_type: str) -> None:
+    """Add the valid questions of each reply; a failed request just leaves its section short."""
+    errors = []
+    for i, result in zip(indexes, results):
+        if isinstance(result, BaseException):
+            errors.append(result)
+            continue
+        with span("quiz.parse", section=i + 1) as current:
+            questions, rejected = _parse_questions(result, quiz_type)
+            current.set(valid=len(questions), rejected=rejected)
+        quiz.rejected += rejected
+        quiz.add(i, questions)
+    if errors and not quiz.questions():
+        raise errors[0]
+
+
+def _generate_sections(sections: list[tuple[str, int]], quiz_type: str, fast: bool) -> _QuizSections:
     """
-    Strip markdown code fences and whitespace from a raw LLM response
-    so it can be safely parsed as JSON.
+    Request every section's questions in parallel, then ask once more for
+    whatever is still missing (malformed, off-schema or duplicate entries).
     """
-    raw = raw.strip()
-    # Remove ```json ... ``` or ``` ... ``` fences
-    raw = re.sub(r"^```(?:json)?\s*", "", raw)
-    raw = re.sub(r"\s*```$", "", raw)
-    return raw.strip()
+    quiz = _QuizSections(sections)
+
+    def complete(i, messages, top_up):
+        with span("quiz.shard", section=i + 1, top_up=top_up):
+            try:
+                # A top-up must not be answered with the cached reply that came up short
+                return chat_completion(messages, temperature=0.6, use_cache=not top_up)
+            except Exception as exc:
+                return exc
+
+    requests = [(i, count) for i, (_, count) in enumerate(sections)]
+    with ThreadPoolExecutor(max_workers=min(get_map_concurrency(), len(sections)), thread_name_prefix="quiz") as pool:
+        for top_up in (False, True):
+            quiz.top_ups = len(requests) if top_up else 0
+            tasks = _section_tasks(quiz, requests, quiz_type, fast, top_up)
+            # Copy the context per task so spans nest under the caller's span
+            futures = [pool.submit(contextvars.copy_context().run, complete, i, messages, top_up) for i, messages in tasks]
+            _collect(quiz, [i for i, _ in tasks], [future.result() for future in futures], quiz_type)
+            requests = quiz.shortfall()
+            if not requests:
+                break
+    return quiz
+
+
+async def _agenerate_sections(sections: list[tuple[str, int]], quiz_type: str, fast: bool) -> _QuizSections:
+    quiz = _QuizSections(sections)
+
+    async def complete(i, messages, top_up):
+        with span("quiz.shard", section=i + 1, top_up=top_up):
+            return await achat_completion(messages, temperature=0.6, use_cache=not top_up)
+
+    requests = [(i, count) for i, (_, count) in enumerate(sections)]
+    for top_up in (False, True):
+        quiz.top_ups = len(requests) if top_up else 0
+        tasks = _section_tasks(quiz, requests, quiz_type, fast, top_up)
+        results = await asyncio.gather(*[complete(i, messages, top_up) for i, messages in tasks], return_exceptions=True)
+        _collect(quiz, [i for i, _ in tasks], results, quiz_type)
+        requests = quiz.shortfall()
+        if not requests:
+            break
+    return quiz
+
+
+def _sections_for(topic_or_notes: str, num_questions: int, sharded: bool) -> list[tuple[str, int]]:
+    """(text, question count) per request: one for topics and short notes, several for long notes."""
+    if not topic_or_notes.strip():
+        raise ValueError("Topic or notes cannot be empty.")
+    num_questions = max(1, min(20, num_questions))  # clamp to 1-20
+    if sharded:
+        notes, _ = remove_boilerplate(topic_or_notes, get_model())
+        sections = _plan_shards(notes, num_questions)
+        if len(sections) > 1:
+            return sections
+    return [(topic_or_notes, num_questions)]
 
 
 def generate_quiz(
     topic_or_notes: str,
     num_questions: int = 5,
     quiz_type: str = "MCQ",
+    fast: bool = False,
+    sharded: bool = True,
 ) -> list[dict]:
     """
     Generate a quiz as a list of question dicts.
 
+    Valid questions are kept even when the reply is truncated or has bad
+    entries (wrong option count, answer not among the options, ...); one
+    follow-up request asks only for the questions that are still missing.
+
     Args:
         topic_or_notes: A topic name or raw study notes
         num_questions: Number of questions to generate (1-20)
         quiz_type: "MCQ" or "True/False"
+        fast: Condense long notes locally (extractive) before prompting
+        sharded: Split long notes into sections that are questioned in
+            parallel (questions shared out by section length, near-duplicates
+            dropped, shortfalls topped up once)
 
     Returns:
         List of question dicts. MCQ format:
@@ -42,37 +365,107 @@ def generate_quiz(
             {"question": str, "answer": str, "explanation": str}
 
     Raises:
-        ValueError: If the LLM response cannot be parsed as JSON.
+        ValueError: If no valid question could be recovered from the model's replies.
     """
-    if not topic_or_notes.strip():
-        raise ValueError("Topic or notes cannot be empty.")
+    with span("quiz.generate", feature="quiz", quiz_type=quiz_type, requested=num_questions, fast=fast) as current:
+        sections = _sections_for(topic_or_notes, num_questions, sharded)
+        return _generate_sections(sections, quiz_type, fast).report(current)
 
-    num_questions = max(1, min(20, num_questions))  # clamp to 1-20
 
-    messages = [
-        {"role": "system", "content": QUIZ_SYSTEM},
-        {"role": "user", "content": quiz_user_prompt(topic_or_notes, num_questions, quiz_type)},
-    ]
+async def agenerate_quiz(
+    topic_or_notes: str,
+    num_questions: int = 5,
+    quiz_type: str = "MCQ",
+    fast: bool = False,
+    sharded: bool = True,
+) -> list[dict]:
+    """Async version of generate_quiz()."""
+    with span("quiz.generate", feature="quiz", quiz_type=quiz_type, requested=num_questions, fast=fast) as current:
+        sections = _sections_for(topic_or_notes, num_questions, sharded)
+        return (await _agenerate_sections(sections, quiz_type, fast)).report(current)
 
-    raw = chat_completion(messages, temperature=0.6)
-    cleaned = _clean_json(raw)
 
-    try:
-        questions = json.loads(cleaned)
-    except json.JSONDecodeError:
-        # Attempt to extract a JSON array from the response
-        match = re.search(r"\[.*\]", cleaned, re.DOTALL)
-        if match:
-            questions = json.loads(match.group())
-        else:
-            raise ValueError(
-                f"Could not parse quiz JSON from model response.\nRaw response:\n{raw}"
-            )
+def _stream_section(i: int, messages: list[dict], quiz_type: str, top_up: bool, out: queue.Queue, stop: threading.Event) -> None:
+    """
+    Stream one section's reply onto `out`: ("item", i, question or None) per
+    array element as it completes, then ("done", i, skipped, error).
+    """
+    skipped, error = 0, None
+    with span("quiz.shard", section=i + 1, top_up=top_up):
+        try:
+            parser = JSONArrayStream(strict=False)
+            # A top-up must not be answered with the cached reply that came up short
+            for delta in stream_chat_completion(messages, temperature=0.6, use_cache=not top_up):
+                if stop.is_set():
+                    break
+                for item in parser.feed(delta):
+                    out.put(("item", i, _valid_question(item, quiz_type)))
+            parser.close()
+            skipped = parser.skipped
+        except Exception as exc:
+            error = exc
+    out.put(("done", i, skipped, error))
+
+
+def generate_quiz_stream(
+    topic_or_notes: str,
+    num_questions: int = 5,
+    quiz_type: str = "MCQ",
+    fast: bool = False,
+    sharded: bool = True,
+) -> Iterator[dict]:
+    """
+    Streaming version of generate_quiz(): yields each question dict as soon
+    as the model has finished writing it, so the first question shows up
+    after roughly one question's generation time. Sections of long notes
+    are streamed in parallel and their questions yielded as they arrive.
+    Malformed entries are skipped and the missing questions streamed from
+    one follow-up round.
+
+    Raises:
+        ValueError: If no valid question could be recovered from the model's replies.
+    """
+    with span("quiz.generate", feature="quiz", quiz_type=quiz_type, requested=num_questions, fast=fast, stream=True) as current:
+        sections = _sections_for(topic_or_notes, num_questions, sharded)
+        quiz = _QuizSections(sections)
+        requests = [(i, count) for i, (_, count) in enumerate(sections)]
+        results = queue.Queue()
+        stop = threading.Event()  # set if the caller stops reading early
+        pool = ThreadPoolExecutor(max_workers=min(get_map_concurrency(), len(sections)), thread_name_prefix="quiz")
+        try:
+            for top_up in (False, True):
+                quiz.top_ups = len(requests) if top_up else 0
+                tasks = _section_tasks(quiz, requests, quiz_type, fast, top_up)
+                for i, messages in tasks:
+                    # Copy the context per task so spans nest under the caller's span
+                    pool.submit(contextvars.copy_context().run, _stream_section, i, messages, quiz_type, top_up, results, stop)
 
-    if not isinstance(questions, list):
-        raise ValueError("Expected a JSON array of questions.")
+                errors, pending = [], len(tasks)
+                while pending:
+                    kind, i, *rest = results.get()
+                    if kind == "item":
+                        question = rest[0]
+                        quiz.rejected += question is None
+                        yield from quiz.add(i, [question] if question else [])
+                        continue
+                    skipped, error = rest
+                    quiz.rejected += skipped
+                    if error is not None:
+                        errors.append(error)
+                    pending -= 1
+                if errors and not quiz.questions():
+                    raise errors[0]
 
-    return questions
+                shown = {id(q) for q in quiz.questions()}
+                requests = quiz.shortfall()
+                # Spare questions moved into short sections have not been yielded yet
+                yield from (q for q in quiz.questions() if id(q) not in shown)
+                if not requests:
+                    break
+        finally:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        quiz.report(current)
 
 
 def score_quiz(questions: list[dict], user_answers: dict[int, str]) -> dict:
@@ -4,27 +4,294 @@ Summarizes study notes or uploaded document text using an LLM.
 Handles chunking for long documents automatically.
 """
 
-from utils.config import chat_completion
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable
+
+from utils.config import (
+    chat_completion,
+    achat_completion,
+    get_input_budget,
+    get_map_concurrency,
+    get_model,
+    get_summary_cache,
+)
+from utils.cache import make_key
+from utils.extractive import FAST_MODE_TOKENS, compress, extractive_summary, key_terms
 from utils.prompts import (
     SUMMARIZER_SYSTEM,
     summarizer_user_prompt,
     summarizer_chunk_prompt,
     merge_summaries_prompt,
+    combine_summaries_prompt,
+    SUMMARY_PROMPT_VERSION,
 )
-from utils.pdf_reader import chunk_text
+from utils.pdf_reader import BoilerplateFilter, chunk_spans, iter_chunks, remove_boilerplate
+from utils.rate_limit import is_retryable, retry_delay
+from utils.telemetry import incr_attribute, set_attributes, span
+from utils.tokens import count_tokens, count_message_tokens, truncate_to_tokens
+
+# Completion room reserved when sizing summary prompts
+SUMMARY_OUTPUT_TOKENS = 2048
+# Tokens repeated between neighbouring chunks
+CHUNK_OVERLAP_TOKENS = 150
+# Smallest chunk worth a map call, even when the input budget is tiny
+MIN_CHUNK_TOKENS = 200
+# Extra rounds for chunks whose summary still failed after the router's retries
+MAP_CHUNK_RETRIES = 2
+# Sentences kept by the offline (extractive) summary, per style
+OFFLINE_SENTENCES = {"concise": 5, "structured": 10, "detailed": 20}
+# Allowance for the "Section N Summary:" header and separator around each partial summary
+SECTION_OVERHEAD_TOKENS = 16
+
+
+def _single_messages(notes: str, style: str) -> list[dict]:
+    return [
+        {"role": "system", "content": SUMMARIZER_SYSTEM},
+        {"role": "user", "content": summarizer_user_prompt(notes, style)},
+    ]
+
+
+def _chunk_messages(chunk: str, chunk_num: int, total: int = None) -> list[dict]:
+    return [
+        {"role": "system", "content": SUMMARIZER_SYSTEM},
+        {"role": "user", "content": summarizer_chunk_prompt(chunk, chunk_num, total)},
+    ]
+
+
+def _merge_messages(partial_summaries: list[str]) -> list[dict]:
+    return [
+        {"role": "system", "content": SUMMARIZER_SYSTEM},
+        {"role": "user", "content": merge_summaries_prompt(partial_summaries)},
+    ]
+
+
+def _combine_messages(partial_summaries: list[str], first_section: int) -> list[dict]:
+    return [
+        {"role": "system", "content": SUMMARIZER_SYSTEM},
+        {"role": "user", "content": combine_summaries_prompt(partial_summaries, first_section)},
+    ]
+
+
+def get_chunk_threshold(style: str = "structured") -> int:
+    """Largest document (in tokens) summarized in a single call."""
+    overhead = count_message_tokens(_single_messages("", style), get_model())
+    return get_input_budget(SUMMARY_OUTPUT_TOKENS) - overhead
+
+
+def needs_chunking(notes: str, style: str = "structured") -> bool:
+    """True if `notes` is too long for one call and will be chunked."""
+    return count_tokens(notes, get_model()) > get_chunk_threshold(style)
+
+
+def _chunk_budget() -> int:
+    """
+    Largest chunk (in tokens) whose map prompt fits the input budget, but
+    never below MIN_CHUNK_TOKENS: a small TPM or LLM_MAX_INPUT_TOKENS must
+    not shrink chunks to a handful of tokens each.
+    """
+    overhead = count_message_tokens(_chunk_messages("", 1, 1), get_model())
+    return max(MIN_CHUNK_TOKENS, get_input_budget(SUMMARY_OUTPUT_TOKENS) - overhead)
+
+
+def _chunk_overlap(budget: int) -> int:
+    """Tokens repeated between neighbouring chunks: at most a tenth of a chunk."""
+    return min(CHUNK_OVERLAP_TOKENS, budget // 10)
+
+
+def _split(notes: str) -> list[tuple[int, int]]:
+    """
+    Chunk spans (offsets into `notes`) sized so each map prompt fits the
+    input budget. Boundaries are content-defined so an edited document keeps
+    its unchanged chunks. Chunk text is sliced out only when it is sent.
+    """
+    budget = _chunk_budget()
+    return chunk_spans(
+        notes,
+        max_tokens=budget,
+        overlap=_chunk_overlap(budget),
+        model=get_model(),
+        content_defined=True,
+    )
+
+
+def _condense(notes: str, style: str) -> str:
+    """Fast mode: keep the key sentences so the notes fit one small prompt."""
+    with span("summarize.condense") as current:
+        budget = min(FAST_MODE_TOKENS, get_chunk_threshold(style))
+        condensed = compress(notes, budget, get_model())
+        current.set(tokens_in=count_tokens(notes, get_model()), tokens_out=count_tokens(condensed, get_model()))
+    return condensed
+
+
+def _chunk_key(chunk: str) -> str:
+    # Position ("part i of N") is deliberately left out so moved chunks are reused
+    return make_key("summary_chunk", SUMMARY_PROMPT_VERSION, get_model(), chunk)
+
+
+def _memoized_summaries(chunks: Iterable[str]) -> list:
+    """Stored summaries for `chunks` (None where a chunk is new or changed)."""
+    cache = get_summary_cache()
+    if cache is None:
+        return [None for _ in chunks]
+    return [cache.get(_chunk_key(chunk)) for chunk in chunks]
+
+
+def _memoize_summary(chunk: str, summary: str) -> None:
+    cache = get_summary_cache()
+    if cache is not None:
+        cache.set(_chunk_key(chunk), summary)
+
+
+class _Progress:
+    """Counts finished LLM calls; `total` grows as reduce levels are planned."""
+
+    def __init__(self, callback, total: int):
+        self.callback = callback
+        self.done = 0
+        self.total = total
+
+    def add(self, steps: int) -> None:
+        self.total += steps
+
+    def step(self) -> None:
+        self.done += 1
+        if self.callback:
+            self.callback(self.done, self.total)
+
+
+def _summarize_chunk(chunk: str, index: int, total: int = None) -> str:
+    with span("summarize.map", chunk=index + 1):
+        summary = chat_completion(_chunk_messages(chunk, index + 1, total), temperature=0.3)
+    _memoize_summary(chunk, summary)
+    return summary
+
+
+def _combine_group(group: list[str], first_section: int, level: int) -> str:
+    with span("summarize.combine", level=level, sections=len(group)):
+        return chat_completion(_combine_messages(group, first_section), temperature=0.3)
+
+
+def _run_parallel(tasks: list, max_workers: int, progress: _Progress = None) -> list:
+    """
+    Run zero-argument `tasks` on a thread pool and return their results in order.
+    Tasks that fail with a retryable error are re-run on their own (finished
+    ones are kept). Progress is reported on the calling thread.
+    """
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks)), thread_name_prefix="summarize") as pool:
+        for attempt in range(MAP_CHUNK_RETRIES + 1):
+            # Copy the context per task so spans nest under the caller's span
+            futures = {pool.submit(contextvars.copy_context().run, tasks[i]): i for i in pending}
+            failed, error = [], None
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as exc:
+                    if not is_retryable(exc):
+                        for other in futures:
+                            other.cancel()
+                        raise
+                    failed.append(i)
+                    error = error or exc
+                    continue
+                if progress:
+                    progress.step()
+
+            if not failed:
+                return results
+            if attempt >= MAP_CHUNK_RETRIES:
+                raise error
+            incr_attribute("chunk_retries", len(failed))
+            pending = sorted(failed)
+            time.sleep(retry_delay(error, attempt))
+
+
+def _merge_budget() -> int:
+    """Tokens of partial summaries one final merge prompt can hold."""
+    overhead = count_message_tokens(_merge_messages([]), get_model())
+    return get_input_budget(SUMMARY_OUTPUT_TOKENS) - overhead
+
+
+def _plan_groups(summaries: list[str]) -> list[tuple[int, list[str]]]:
+    """
+    Pack consecutive summaries into groups that each fit one combine prompt.
+    Returns (index of first summary, group) pairs. Every summary is capped at
+    half the budget, so each group holds at least two and the level shrinks.
+    """
+    model = get_model()
+    overhead = count_message_tokens(_combine_messages([], 1), model)
+    budget = get_input_budget(SUMMARY_OUTPUT_TOKENS) - overhead
+    cap = budget // 2 - SECTION_OVERHEAD_TOKENS
+
+    groups, current, used = [], [], 0
+    start = 0
+    for i, summary in enumerate(summaries):
+        summary = truncate_to_tokens(summary, cap, model)
+        size = count_tokens(summary, model) + SECTION_OVERHEAD_TOKENS
+        if current and used + size > budget:
+            groups.append((start, current))
+            current, used, start = [], 0, i
+        current.append(summary)
+        used += size
+    groups.append((start, current))
+    return groups
 
-# Max words per chunk before we split the document
-CHUNK_THRESHOLD_WORDS = 2500
 
+def _fits_final_merge(summaries: list[str]) -> bool:
+    model = get_model()
+    used = sum(count_tokens(s, model) + SECTION_OVERHEAD_TOKENS for s in summaries)
+    return len(summaries) == 1 or used <= _merge_budget()
 
-def summarize_notes(notes: str, style: str = "structured") -> str:
+
+def _reduce(summaries: list[str], max_workers: int, progress: _Progress) -> list[str]:
+    """
+    Tree-reduce partial summaries until they fit one final merge prompt.
+    Each level combines groups in parallel, so depth grows logarithmically
+    with document length.
     """
-    Summarize the provided text. Automatically handles long documents
-    by chunking and merging partial summaries.
+    level = 0
+    while not _fits_final_merge(summaries):
+        level += 1
+        groups = _plan_groups(summaries)
+        with span("summarize.reduce", level=level, inputs=len(summaries), groups=len(groups)):
+            tasks = [
+                (lambda g=group, s=start: _combine_group(g, s + 1, level))
+                for start, group in groups if len(group) > 1
+            ]
+            progress.add(len(tasks))
+            combined = iter(_run_parallel(tasks, max_workers, progress))
+            # A trailing single-summary group is carried up unchanged
+            summaries = [next(combined) if len(group) > 1 else group[0] for _, group in groups]
+    set_attributes(reduce_levels=level)
+    return summaries
+
+
+def summarize_notes(
+    notes: str,
+    style: str = "structured",
+    max_workers: int = None,
+    progress_callback=None,
+    fast: bool = False,
+) -> str:
+    """
+    Summarize the provided text. Repeated headers/footers and duplicate
+    pages are dropped first; long documents are then chunked, chunks are
+    summarized in parallel, and the partial summaries are merged — in
+    parallel rounds first if they are too long for a single merge.
 
     Args:
         notes: Raw text of the study notes
         style: "structured" | "concise" | "detailed"
+        max_workers: LLM calls in flight at once (default LLM_MAP_CONCURRENCY)
+        progress_callback: Optional fn(done, total) called as LLM calls finish;
+            `total` can grow once merge rounds are planned
+        fast: Condense the notes locally (extractive) into one prompt first
 
     Returns:
         A formatted summary string (markdown)
@@ -32,36 +299,237 @@ def summarize_notes(notes: str, style: str = "structured") -> str:
     if not notes.strip():
         raise ValueError("Notes cannot be empty.")
 
-    word_count = len(notes.split())
-
-    # Short document: single API call
-    if word_count <= CHUNK_THRESHOLD_WORDS:
-        messages = [
-            {"role": "system", "content": SUMMARIZER_SYSTEM},
-            {"role": "user", "content": summarizer_user_prompt(notes, style)},
-        ]
-        return chat_completion(messages, temperature=0.4)
-
-    # Long document: chunk → summarize each → merge
-    chunks = chunk_text(notes, max_tokens=2500, overlap=150)
-    partial_summaries = []
-
-    for i, chunk in enumerate(chunks):
-        messages = [
-            {"role": "system", "content": SUMMARIZER_SYSTEM},
-            {"role": "user", "content": summarizer_chunk_prompt(chunk, i + 1, len(chunks))},
-        ]
-        partial_summary = chat_completion(messages, temperature=0.3)
-        partial_summaries.append(partial_summary)
-
-    # Merge all partial summaries into one final summary
-    merge_messages = [
-        {"role": "system", "content": SUMMARIZER_SYSTEM},
-        {"role": "user", "content": merge_summaries_prompt(partial_summaries)},
-    ]
-    return chat_completion(merge_messages, temperature=0.4)
+    with span("summarize", feature="summarizer", style=style, fast=fast) as current:
+        notes, _ = remove_boilerplate(notes, get_model())
+        if fast:
+            notes = _condense(notes, style)
+
+        # Short document: single API call
+        if not needs_chunking(notes, style):
+            current.set(chunks=1)
+            return chat_completion(_single_messages(notes, style), temperature=0.4)
+
+        # Long document: chunk → summarize each (in parallel) → reduce → merge
+        with span("summarize.chunk"):
+            chunks = _split(notes)
+        current.set(chunks=len(chunks))
+        max_workers = max_workers or get_map_concurrency()
+        progress = _Progress(progress_callback, total=len(chunks) + 1)
+
+        # Only chunks that are new or changed since a previous run reach the LLM
+        partial_summaries = _memoized_summaries(notes[start:end] for start, end in chunks)
+        changed = [i for i, summary in enumerate(partial_summaries) if summary is None]
+        current.set(chunks_reused=len(chunks) - len(changed))
+        for _ in range(len(chunks) - len(changed)):
+            progress.step()
+
+        if changed:
+            tasks = [
+                (lambda i=i: _summarize_chunk(notes[slice(*chunks[i])], i, len(chunks)))
+                for i in changed
+            ]
+            for i, summary in zip(changed, _run_parallel(tasks, max_workers, progress)):
+                partial_summaries[i] = summary
+        return _merge_partials(partial_summaries, max_workers, progress)
+
+
+def summarize_stream(
+    pieces,
+    style: str = "structured",
+    max_workers: int = None,
+    progress_callback=None,
+) -> str:
+    """
+    Summarize text that arrives in pieces (e.g. pdf_reader.stream_text()),
+    sending each chunk to the LLM as soon as it is cut so extraction
+    overlaps with the map phase. Chunks — and memoized chunk summaries —
+    are the same as summarize_notes() would use on the joined text.
+
+    Args:
+        pieces: Iterable of text pieces, in document order
+        style: "structured" | "concise" | "detailed"
+        max_workers: LLM calls in flight at once (default LLM_MAP_CONCURRENCY)
+        progress_callback: Optional fn(done, total); `total` grows as chunks are cut
+
+    Returns:
+        A formatted summary string (markdown)
+    """
+    with span("summarize", feature="summarizer", style=style, mode="stream") as current:
+        model = get_model()
+        threshold = get_chunk_threshold(style)
+        max_workers = max_workers or get_map_concurrency()
+        progress = _Progress(progress_callback, total=1)
+        # Same cleaning as summarize_notes(), page by page
+        cleaner = BoilerplateFilter(model)
+        pieces = cleaner.filter(pieces)
+
+        received, received_tokens = [], 0
+
+        def tee():
+            nonlocal received_tokens
+            for piece in pieces:
+                received.append(piece)
+                received_tokens += count_tokens(piece, model)
+                yield piece
+
+        chunks, results, futures, failed = [], {}, {}, []
+        reused = 0
+        # Chunks are held back until the text is known not to fit one call
+        held = True
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarize") as pool:
+            def dispatch(index):
+                nonlocal reused
+                progress.add(1)
+                memo = _memoized_summaries([chunks[index]])[0]
+                if memo is not None:
+                    results[index] = memo
+                    reused += 1
+                    progress.step()
+                    return
+                task = pool.submit(contextvars.copy_context().run, _summarize_chunk, chunks[index], index)
+                futures[task] = index
+
+            def collect(block: bool):
+                finished = as_completed(list(futures)) if block else [f for f in list(futures) if f.done()]
+                for future in finished:
+                    index = futures.pop(future)
+                    try:
+                        results[index] = future.result()
+                    except Exception as exc:
+                        if not is_retryable(exc):
+                            for other in futures:
+                                other.cancel()
+                            raise
+                        failed.append(index)
+                        continue
+                    progress.step()
+
+            budget = _chunk_budget()
+            for chunk in iter_chunks(tee(), budget, _chunk_overlap(budget), model):
+                chunks.append(chunk)
+                if held:
+                    if received_tokens <= threshold:
+                        continue
+                    held = False
+                    for index in range(len(chunks)):
+                        dispatch(index)
+                else:
+                    dispatch(len(chunks) - 1)
+                collect(block=False)
+
+            text = "\n\n".join(received)
+            current.set(tokens_saved=cleaner.report["tokens_saved"], pages_dropped=cleaner.report["pages_dropped"])
+            if not text.strip():
+                raise ValueError("Notes cannot be empty.")
+            if held:
+                # The whole document fits one call after all
+                current.set(chunks=1)
+                summary = chat_completion(_single_messages(text, style), temperature=0.4)
+                progress.step()
+                return summary
+            collect(block=True)
+
+        current.set(chunks=len(chunks), chunks_reused=reused)
+        if failed:
+            incr_attribute("chunk_retries", len(failed))
+            tasks = [(lambda i=i: _summarize_chunk(chunks[i], i)) for i in sorted(failed)]
+            for i, summary in zip(sorted(failed), _run_parallel(tasks, max_workers, progress)):
+                results[i] = summary
+        return _merge_partials([results[i] for i in range(len(chunks))], max_workers, progress)
+
+
+def _merge_partials(partial_summaries: list[str], max_workers: int, progress: _Progress) -> str:
+    """Reduce (if needed) and merge partial summaries into the final summary."""
+    partial_summaries = _reduce(partial_summaries, max_workers, progress)
+    with span("summarize.merge", inputs=len(partial_summaries)):
+        summary = chat_completion(_merge_messages(partial_summaries), temperature=0.4)
+    progress.step()
+    return summary
+
+
+async def asummarize_notes(notes: str, style: str = "structured", fast: bool = False) -> str:
+    """
+    Async version of summarize_notes(). Chunk summaries are requested
+    concurrently; the process-wide limiter in utils.config caps how many
+    are in flight at once.
+    """
+    if not notes.strip():
+        raise ValueError("Notes cannot be empty.")
+
+    with span("summarize", feature="summarizer", style=style, mode="async", fast=fast) as current:
+        notes, _ = remove_boilerplate(notes, get_model())
+        if fast:
+            notes = _condense(notes, style)
+
+        if not needs_chunking(notes, style):
+            current.set(chunks=1)
+            return await achat_completion(_single_messages(notes, style), temperature=0.4)
+
+        with span("summarize.chunk"):
+            chunks = _split(notes)
+        current.set(chunks=len(chunks))
+
+        async def summarize_chunk(i, chunk):
+            with span("summarize.map", chunk=i + 1):
+                summary = await achat_completion(_chunk_messages(chunk, i + 1, len(chunks)), temperature=0.3)
+            _memoize_summary(chunk, summary)
+            return summary
+
+        partial_summaries = _memoized_summaries(notes[start:end] for start, end in chunks)
+        changed = [i for i, summary in enumerate(partial_summaries) if summary is None]
+        current.set(chunks_reused=len(chunks) - len(changed))
+        results = await asyncio.gather(*[summarize_chunk(i, notes[slice(*chunks[i])]) for i in changed])
+        for i, summary in zip(changed, results):
+            partial_summaries[i] = summary
+
+        async def combine_group(group, first_section, level):
+            with span("summarize.combine", level=level, sections=len(group)):
+                return await achat_completion(_combine_messages(group, first_section), temperature=0.3)
+
+        level = 0
+        while not _fits_final_merge(partial_summaries):
+            level += 1
+            groups = _plan_groups(partial_summaries)
+            with span("summarize.reduce", level=level, inputs=len(partial_summaries), groups=len(groups)):
+                combined = iter(await asyncio.gather(*[
+                    combine_group(group, start + 1, level) for start, group in groups if len(group) > 1
+                ]))
+                partial_summaries = [next(combined) if len(group) > 1 else group[0] for _, group in groups]
+        current.set(reduce_levels=level)
+
+        with span("summarize.merge", inputs=len(partial_summaries)):
+            return await achat_completion(_merge_messages(partial_summaries), temperature=0.4)
+
+
+def summarize_offline(notes: str, style: str = "structured") -> str:
+    """
+    Summary built entirely offline from the notes' most central sentences
+    (no provider call). Sentences are quoted as written, not rewritten.
+    """
+    if not notes.strip():
+        raise ValueError("Notes cannot be empty.")
+
+    with span("summarize.offline", feature="summarizer", style=style):
+        notes, _ = remove_boilerplate(notes)
+        sentences = extractive_summary(notes, OFFLINE_SENTENCES.get(style, OFFLINE_SENTENCES["structured"]))
+        terms = key_terms(notes, 8)
+
+    lines = ["## Key Points", ""]
+    if style == "concise":
+        lines.append(" ".join(sentences))
+    else:
+        lines.extend(f"- {sentence}" for sentence in sentences)
+    if terms:
+        lines += ["", f"**Important Terms**: {', '.join(terms)}"]
+    return "\n".join(lines)
 
 
 def get_word_count(text: str) -> int:
     """Return approximate word count of a string."""
     return len(text.split())
+
+
+def get_token_count(text: str) -> int:
+    """Return the model token count of a string."""
+    return count_tokens(text, get_model())
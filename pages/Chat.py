@@ -2,7 +2,7 @@ import streamlit as st
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from core.chat import get_ai_response, build_history
+from core.chat import get_ai_response_stream, build_history
 from utils.pdf_reader import extract_text
 
 st.set_page_config(page_title="Study Chat", page_icon="💬", layout="wide")
@@ -89,20 +89,19 @@ if user_input:
 
     # Get AI response
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            try:
-                history = build_history(st.session_state.messages[:-1])  # exclude last user msg
-                response = get_ai_response(
-                    conversation_history=history,
-                    user_message=user_input,
-                    study_context=st.session_state.chat_context,
-                )
-                st.markdown(response)
-                st.session_state.messages.append({"role": "assistant", "content": response})
-            except Exception as e:
-                error_msg = f"❌ Error: {e}"
-                st.error(error_msg)
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+        try:
+            history = build_history(st.session_state.messages[:-1])  # exclude last user msg
+            # Render tokens as they arrive instead of waiting for the full reply
+            response = st.write_stream(get_ai_response_stream(
+                conversation_history=history,
+                user_message=user_input,
+                study_context=st.session_state.chat_context,
+            ))
+            st.session_state.messages.append({"role": "assistant", "content": response})
+        except Exception as e:
+            error_msg = f"❌ Error: {e}"
+            st.error(error_msg)
+            st.session_state.messages.append({"role": "assistant", "content": error_msg})
 
 # ── Export Chat ──
 if len(st.session_state.messages) > 2:
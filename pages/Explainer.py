@@ -2,7 +2,7 @@ import streamlit as st
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from core.explainer import explain_concept, DIFFICULTY_LEVELS
+from core.explainer import explain_concept_stream, DIFFICULTY_LEVELS
 
 st.set_page_config(page_title="Concept Explainer", page_icon="💡", layout="wide")
 
@@ -38,22 +38,26 @@ explain_btn = st.button("✨ Explain This Topic", type="primary", use_container_
 st.divider()
 
 # ── Output ──
+just_streamed = False
 if explain_btn:
     if not topic.strip():
         st.warning("Please enter a topic to explain.")
     else:
-        with st.spinner(f"Generating explanation for **{topic}** at {level} level..."):
-            try:
-                explanation = explain_concept(topic, level, extra_context)
-                st.session_state["last_explanation"] = {"topic": topic, "level": level, "content": explanation}
-            except Exception as e:
-                st.error(f"Error generating explanation: {e}")
-                st.stop()
+        # Stream tokens straight onto the page as they are generated
+        st.subheader(f"📖 {topic} — {level}")
+        try:
+            explanation = st.write_stream(explain_concept_stream(topic, level, extra_context))
+            st.session_state["last_explanation"] = {"topic": topic, "level": level, "content": explanation}
+            just_streamed = True
+        except Exception as e:
+            st.error(f"Error generating explanation: {e}")
+            st.stop()
 
 if "last_explanation" in st.session_state:
     exp = st.session_state["last_explanation"]
-    st.subheader(f"📖 {exp['topic']} — {exp['level']}")
-    st.markdown(exp["content"])
+    if not just_streamed:
+        st.subheader(f"📖 {exp['topic']} — {exp['level']}")
+        st.markdown(exp["content"])
     st.divider()
 
     # Download as text
@@ -2,8 +2,8 @@ import streamlit as st
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from core.flashcard_gen import generate_flashcards, export_flashcards_csv
-from utils.pdf_reader import extract_text
+from core.flashcard_gen import generate_flashcards_stream, export_flashcards_csv
+from utils.pdf_reader import extract_text, open_document
 
 st.set_page_config(page_title="Flashcard Maker", page_icon="🃏", layout="wide")
 
@@ -87,6 +87,7 @@ prefill = st.session_state.pop("prefill_flashcard", "")
 with st.expander("⚙️ Flashcard Settings", expanded=not bool(st.session_state.flashcards)):
     source_type = st.radio("Source", ["Topic Name", "My Notes / File"], horizontal=True)
 
+    fast_mode = False
     if source_type == "Topic Name":
         fc_input = st.text_input(
             "Topic",
@@ -95,6 +96,7 @@ with st.expander("⚙️ Flashcard Settings", expanded=not bool(st.session_state
         )
     else:
         input_method = st.radio("Notes As", ["Paste Text", "Upload File"], horizontal=True)
+        fast_mode = st.checkbox("⚡ Fast mode", help="Condense long notes to their key sentences locally before prompting (smaller prompt, faster reply)")
         if input_method == "Paste Text":
             fc_input = st.text_area(
                 "Paste Notes",
@@ -106,12 +108,21 @@ with st.expander("⚙️ Flashcard Settings", expanded=not bool(st.session_state
             uploaded = st.file_uploader("Upload File", type=["pdf", "docx", "txt"])
             fc_input = ""
             if uploaded:
-                with st.spinner("Extracting text..."):
-                    try:
-                        fc_input = extract_text(uploaded)
-                        st.success(f"✅ Loaded `{uploaded.name}`")
-                    except Exception as e:
-                        st.error(str(e))
+                try:
+                    doc = open_document(uploaded)
+                    first, last = 1, doc.page_count
+                    if doc.page_count > 1:
+                        first, last = st.slider("Pages", 1, doc.page_count, (1, doc.page_count),
+                                                help="Only the selected pages are read")
+                    with st.spinner("Extracting text..."):
+                        # Whole PDFs use the cached parallel extractor; DOCX pages are already parsed
+                        if doc.file_type == "pdf" and (first, last) == (1, doc.page_count):
+                            fc_input = extract_text(uploaded)
+                        else:
+                            fc_input = doc.text(range(first, last + 1))
+                    st.success(f"✅ Loaded `{uploaded.name}` (pages {first}–{last} of {doc.page_count})")
+                except Exception as e:
+                    st.error(str(e))
 
     num_cards = st.slider("Number of Cards", min_value=5, max_value=30, value=10)
     generate_btn = st.button("🃏 Generate Flashcards", type="primary", use_container_width=True)
@@ -120,9 +131,17 @@ if generate_btn:
     if not fc_input.strip():
         st.warning("Please enter a topic or provide notes.")
     else:
+        # Cards are previewed as they stream in; the viewer follows once the deck is complete
+        preview = st.empty()
+        cards = []
         with st.spinner("Creating your flashcard deck..."):
             try:
-                cards = generate_flashcards(fc_input, num_cards)
+                for card in generate_flashcards_stream(fc_input, num_cards, fast=fast_mode):
+                    cards.append(card)
+                    preview.markdown("\n\n".join(
+                        f"**{i+1}. {c['front']}** — {c['back']}" for i, c in enumerate(cards)
+                    ) + "\n\n_Writing more cards..._")
+                preview.empty()
                 st.session_state.flashcards = cards
                 st.session_state.card_index = 0
                 st.session_state.show_back = False
@@ -2,9 +2,9 @@ import streamlit as st
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from core.quiz_gen import generate_quiz, score_quiz
+from core.quiz_gen import generate_quiz_stream, score_quiz
 from utils.pdf_export import export_quiz_pdf
-from utils.pdf_reader import extract_text
+from utils.pdf_reader import extract_text, open_document
 
 st.set_page_config(page_title="Quiz Generator", page_icon="📝", layout="wide")
 
@@ -32,6 +32,7 @@ with st.expander("⚙️ Quiz Settings", expanded=True):
     with col3:
         num_questions = st.slider("Number of Questions", min_value=3, max_value=15, value=5)
 
+    fast_mode = False
     if source_type == "Topic Name":
         quiz_input = st.text_input(
             "Topic",
@@ -40,6 +41,7 @@ with st.expander("⚙️ Quiz Settings", expanded=True):
         )
     else:
         input_method = st.radio("Provide Notes As", ["Paste Text", "Upload File"], horizontal=True)
+        fast_mode = st.checkbox("⚡ Fast mode", help="Condense long notes to their key sentences locally before prompting (smaller prompt, faster reply)")
         if input_method == "Paste Text":
             quiz_input = st.text_area("Paste Notes", height=150,
                                        placeholder="Paste your study notes here...")
@@ -47,12 +49,21 @@ with st.expander("⚙️ Quiz Settings", expanded=True):
             uploaded = st.file_uploader("Upload File", type=["pdf", "docx", "txt"])
             quiz_input = ""
             if uploaded:
-                with st.spinner("Extracting text..."):
-                    try:
-                        quiz_input = extract_text(uploaded)
-                        st.success(f"✅ Loaded `{uploaded.name}`")
-                    except Exception as e:
-                        st.error(str(e))
+                try:
+                    doc = open_document(uploaded)
+                    first, last = 1, doc.page_count
+                    if doc.page_count > 1:
+                        first, last = st.slider("Pages", 1, doc.page_count, (1, doc.page_count),
+                                                help="Only the selected pages are read")
+                    with st.spinner("Extracting text..."):
+                        # Whole PDFs use the cached parallel extractor; DOCX pages are already parsed
+                        if doc.file_type == "pdf" and (first, last) == (1, doc.page_count):
+                            quiz_input = extract_text(uploaded)
+                        else:
+                            quiz_input = doc.text(range(first, last + 1))
+                    st.success(f"✅ Loaded `{uploaded.name}` (pages {first}–{last} of {doc.page_count})")
+                except Exception as e:
+                    st.error(str(e))
 
     generate_btn = st.button("🎲 Generate Quiz", type="primary", use_container_width=True)
 
@@ -61,9 +72,17 @@ if generate_btn:
     if not quiz_input.strip():
         st.warning("Please enter a topic or provide notes.")
     else:
+        # Questions are previewed as they stream in; the interactive form follows once all are ready
+        preview = st.empty()
+        questions = []
         with st.spinner("Generating your quiz..."):
             try:
-                questions = generate_quiz(quiz_input, num_questions, quiz_type)
+                for q in generate_quiz_stream(quiz_input, num_questions, quiz_type, fast=fast_mode):
+                    questions.append(q)
+                    preview.markdown("\n\n".join(
+                        f"**Q{i+1}. {item.get('question', '')}**" for i, item in enumerate(questions)
+                    ) + "\n\n_Writing more questions..._")
+                preview.empty()
                 st.session_state.quiz_questions = questions
                 st.session_state.quiz_topic = quiz_input[:60]
                 st.session_state.quiz_submitted = False
@@ -2,8 +2,15 @@ import streamlit as st
 import sys, os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from core.summarizer import summarize_notes, get_word_count
-from utils.pdf_reader import extract_text
+from core.summarizer import (
+    summarize_notes,
+    summarize_stream,
+    summarize_offline,
+    get_word_count,
+    get_token_count,
+    needs_chunking,
+)
+from utils.pdf_reader import cached_text, extract_text, open_document, stream_text
 
 st.set_page_config(page_title="Note Summarizer", page_icon="📄", layout="wide")
 
@@ -19,6 +26,8 @@ input_method = st.radio(
 )
 
 notes_text = ""
+# PDF not parsed yet: it is read page by page while being summarized
+stream_file = None
 
 if input_method == "✍️ Paste Text":
     notes_text = st.text_area(
@@ -33,14 +42,27 @@ else:
         help="Supported formats: PDF, DOCX, TXT",
     )
     if uploaded_file:
-        with st.spinner("Extracting text from file..."):
-            try:
-                notes_text = extract_text(uploaded_file)
+        try:
+            doc = open_document(uploaded_file)
+            first, last = 1, doc.page_count
+            if doc.page_count > 1:
+                first, last = st.slider("Pages", 1, doc.page_count, (1, doc.page_count),
+                                        help="Only the selected pages are read")
+            if (first, last) != (1, doc.page_count) or doc.file_type != "pdf":
+                # DOCX/TXT pages are already parsed, so this costs nothing extra
+                with st.spinner(f"Extracting pages {first}–{last}..."):
+                    notes_text = doc.text(range(first, last + 1))
+            else:
+                notes_text = cached_text(uploaded_file) or ""
+                if not notes_text:
+                    stream_file = uploaded_file
+                    st.info(f"📄 `{uploaded_file.name}` will be read page by page while it is summarized.")
+            if notes_text:
                 st.success(f"✅ Extracted **{get_word_count(notes_text):,} words** from `{uploaded_file.name}`")
                 with st.expander("Preview extracted text"):
                     st.text(notes_text[:1500] + ("..." if len(notes_text) > 1500 else ""))
-            except Exception as e:
-                st.error(f"Error reading file: {e}")
+        except Exception as e:
+            st.error(f"Error reading file: {e}")
 
 # ── Summary Style ──
 col1, col2 = st.columns([1, 1])
@@ -58,28 +80,87 @@ with col1:
 with col2:
     if notes_text:
         wc = get_word_count(notes_text)
-        st.metric("Word Count", f"{wc:,}", delta="Long doc — will chunk" if wc > 2500 else "Normal length")
+        long_doc = needs_chunking(notes_text, style)
+        st.metric("Word Count", f"{wc:,}", delta="Long doc — will chunk" if long_doc else "Normal length")
+        st.caption(f"≈ {get_token_count(notes_text):,} model tokens")
+
+mode = st.radio(
+    "Mode",
+    options=["ai", "fast", "offline"],
+    format_func=lambda x: {
+        "ai": "🤖 Full AI summary",
+        "fast": "⚡ Fast (AI on key sentences)",
+        "offline": "📴 Offline (key sentences, no AI)",
+    }[x],
+    horizontal=True,
+    help="Fast condenses long notes locally before prompting; Offline never calls the AI.",
+)
 
 summarize_btn = st.button("📝 Summarize Notes", type="primary", use_container_width=True)
 st.divider()
 
 # ── Output ──
-if summarize_btn:
+if summarize_btn and stream_file is not None and mode != "ai":
+    # Fast and offline modes need the whole text up front
+    with st.spinner("Extracting text from file..."):
+        try:
+            notes_text = extract_text(stream_file)
+            stream_file = None
+        except Exception as e:
+            st.error(f"Error reading file: {e}")
+            st.stop()
+
+if summarize_btn and stream_file is not None:
+    progress = st.progress(0.0, text="Reading document...")
+
+    def show_stream_progress(done, total):
+        progress.progress(done / total, text=f"Processed {done} of {total} steps (reading and summarizing)")
+
+    with st.spinner(f"Reading and summarizing `{stream_file.name}`..."):
+        try:
+            st.session_state["last_summary"] = summarize_stream(
+                stream_text(stream_file), style, progress_callback=show_stream_progress
+            )
+        except Exception as e:
+            st.error(f"Summarization failed: {e}")
+            st.stop()
+        finally:
+            progress.empty()
+elif summarize_btn:
     if not notes_text.strip():
         st.warning("Please provide notes to summarize.")
     else:
         wc = get_word_count(notes_text)
         msg = f"Summarizing {wc:,} words..."
-        if wc > 2500:
+        progress = None
+        if mode == "ai" and needs_chunking(notes_text, style):
             msg += " (splitting into chunks for long document)"
+            progress = st.progress(0.0, text="Splitting document into sections...")
+
+        def show_progress(done, total):
+            text = f"Processed {done} of {total} steps"
+            if done == total - 1:
+                text = "Writing the final summary..."
+            progress.progress(done / total, text=text)
 
         with st.spinner(msg):
             try:
-                summary = summarize_notes(notes_text, style)
+                if mode == "offline":
+                    summary = summarize_offline(notes_text, style)
+                else:
+                    summary = summarize_notes(
+                        notes_text,
+                        style,
+                        progress_callback=show_progress if progress else None,
+                        fast=mode == "fast",
+                    )
                 st.session_state["last_summary"] = summary
             except Exception as e:
                 st.error(f"Summarization failed: {e}")
                 st.stop()
+            finally:
+                if progress:
+                    progress.empty()
 
 if "last_summary" in st.session_state:
     st.subheader("📋 Summary")
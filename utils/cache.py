@@ -0,0 +1,235 @@
+"""
+Utility: Two-tier (memory + disk) cache for JSON-serializable values.
+Used to reuse LLM responses for identical requests across sessions
+and process restarts.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(*parts) -> str:
+    """Return a stable SHA-256 hex digest for any JSON-serializable parts."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    In-memory LRU tier backed by an optional on-disk tier.
+
+    Args:
+        directory: Folder for the disk tier (None disables it)
+        ttl: Seconds an entry stays valid (None = never expires)
+        max_items: Max entries kept in memory before LRU eviction
+        max_bytes: Max total size of the disk tier before LRU eviction
+        max_memory_bytes: Max approximate size of the memory tier (None = count
+            entries only); values bigger than this are kept on disk only
+    """
+
+    def __init__(
+        self,
+        directory: str = None,
+        ttl: float = None,
+        max_items: int = 512,
+        max_bytes: int = 200 * 1024 * 1024,
+        max_memory_bytes: int = None,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()   # key -> (created_at, value)
+        self._sizes = {}               # key -> approximate bytes (only with max_memory_bytes)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_bytes = None        # lazily computed on first write
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+        }
+
+    # ── Public API ──
+
+    def get(self, key: str, default=None):
+        """Return the cached value for `key`, or `default` on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry[1]
+                self._forget(key)
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self._stats["misses"] += 1
+                return default
+            self._stats["disk_hits"] += 1
+            self._remember(key, entry)
+        return entry[1]
+
+    def set(self, key: str, value) -> None:
+        """Store `value` (must be JSON-serializable) under `key` in both tiers."""
+        entry = (time.time(), value)
+        with self._lock:
+            self._remember(key, entry)
+            self._stats["writes"] += 1
+        self._write_disk(key, entry)
+
+    def clear(self) -> None:
+        """Drop every entry from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            self._sizes.clear()
+            self._memory_bytes = 0
+            self._disk_bytes = 0
+        for path, _, _ in self._disk_entries():
+            _remove_quietly(path)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters plus current tier sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+            stats["disk_bytes"] = self._disk_bytes or 0
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hits"] = hits
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
+
+    # ── Memory tier ──
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        """Insert into the LRU tier (caller holds the lock)."""
+        self._forget(key)
+        if self.max_memory_bytes is not None:
+            size = _approx_size(entry[1])
+            if size > self.max_memory_bytes:
+                return  # too big for the memory tier; the disk tier still has it
+            self._sizes[key] = size
+            self._memory_bytes += size
+        self._memory[key] = entry
+        while len(self._memory) > self.max_items or (
+            self.max_memory_bytes is not None and self._memory_bytes > self.max_memory_bytes
+        ):
+            self._forget(next(iter(self._memory)))
+            self._stats["evictions"] += 1
+
+    def _forget(self, key: str) -> None:
+        """Drop `key` from the memory tier, if present (caller holds the lock)."""
+        if self._memory.pop(key, None) is not None:
+            self._memory_bytes -= self._sizes.pop(key, 0)
+
+    # ── Disk tier ──
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str, now: float):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if self._expired(record.get("created_at", 0), now):
+            _remove_quietly(path)
+            return None
+
+        # Touch the file so disk eviction is least-recently-used, not oldest-written
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return record["created_at"], record["value"]
+
+    def _write_disk(self, key: str, entry: tuple) -> None:
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": entry[0], "value": entry[1]}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except (OSError, TypeError, ValueError):
+            # A cache that cannot write should never break the request
+            _remove_quietly(tmp_path)
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(s for _, s, _ in self._disk_entries())
+            else:
+                self._disk_bytes += size
+            over_budget = self._disk_bytes > self.max_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _disk_entries(self):
+        """Yield (path, size, last_used) for every file in the disk tier."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _evict_disk(self) -> None:
+        """Delete least-recently-used files until the tier is under 90% of its cap."""
+        entries = sorted(self._disk_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            _remove_quietly(path)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self._stats["evictions"] += evicted
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _approx_size(value) -> int:
+    """Rough memory footprint of a cached value."""
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    return len(json.dumps(value, ensure_ascii=False))
@@ -0,0 +1,291 @@
+"""
+Utility: Concurrency primitives shared by the sync and async LLM paths.
+
+Streamlit runs every session in its own thread, and each `asyncio.run()`
+creates a fresh event loop, so plain asyncio primitives cannot coordinate
+work process-wide. The classes below can.
+"""
+
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, Future
+
+
+class AsyncLimiter:
+    """
+    Process-wide cap on concurrently running async sections.
+    Safe to share between threads and event loops.
+
+    Usage:
+        async with limiter:
+            await do_request()
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()   # (loop, future) pairs, FIFO
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_flight < self.limit and not self._waiters:
+                self._in_flight += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        future = waiter[1]
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was handed to us just before cancellation — pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._waiters:
+                self._in_flight -= 1
+                return
+            # Hand the slot straight to the next waiter (in_flight unchanged)
+            loop, future = self._waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(self._wake, future)
+        except RuntimeError:
+            # Waiter's loop is already closed
+            self.release()
+
+    def _wake(self, future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls that share a key into one execution.
+    The first caller (the leader) runs the work; everyone who arrives while
+    it is in flight waits and receives the same result or exception.
+    Works across threads and event loops.
+    """
+
+    def __init__(self):
+        self._calls = {}   # key -> concurrent.futures.Future
+        self._lock = threading.Lock()
+        self._stats = {"executions": 0, "coalesced": 0}
+
+    def _join(self, key):
+        """Return (future, is_leader) for `key`."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self._stats["executions"] += 1
+            return future, True
+
+    def _finish(self, key, future) -> None:
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def do(self, key, fn):
+        """Run `fn()` once for all concurrent callers with the same `key`."""
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result()
+                except CancelledError:
+                    continue   # the leader gave up; try again (possibly as leader)
+            try:
+                result = fn()
+            except BaseException as exc:
+                self._finish(key, future)
+                if isinstance(exc, Exception):
+                    future.set_exception(exc)
+                else:
+                    future.cancel()
+                raise
+            self._finish(key, future)
+            future.set_result(result)
+            return result
+
+    async def ado(self, key, fn):
+        """Async version of do(); `fn()` must return an awaitable."""
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    # shield() so a cancelled follower doesn't cancel the shared future
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except asyncio.CancelledError:
+                    if future.cancelled():
+                        continue
+                    raise
+            try:
+                result = await fn()
+            except BaseException as exc:
+                self._finish(key, future)
+                if isinstance(exc, Exception):
+                    future.set_exception(exc)
+                else:
+                    future.cancel()
+                raise
+            self._finish(key, future)
+            future.set_result(result)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+
+class _SharedStream:
+    """The deltas of one in-flight stream, replayable by every reader."""
+
+    def __init__(self, open_fn):
+        self._open_fn = open_fn
+        self._source = None
+        self._parts = []
+        self._error = None
+        self._pumping = False
+        self._cond = threading.Condition()
+        self.readers = 0
+        self.done = False
+
+    def read(self):
+        """Yield every delta from the start; pull the next one from the source when no one else is."""
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self._parts) and not self.done and self._pumping:
+                    self._cond.wait()
+                if i < len(self._parts):
+                    part = self._parts[i]
+                    i += 1
+                    pump = False
+                elif self.done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+                else:
+                    self._pumping = pump = True
+            if pump:
+                self._pump()
+            else:
+                yield part
+
+    def _pump(self) -> None:
+        error, finished = None, False
+        try:
+            if self._source is None:
+                self._source = iter(self._open_fn())
+            part = next(self._source)
+        except StopIteration:
+            finished = True
+        except BaseException as exc:
+            error, finished = exc, True
+        with self._cond:
+            if finished:
+                self.done, self._error = True, error
+            else:
+                self._parts.append(part)
+            self._pumping = False
+            self._cond.notify_all()
+
+    def leave(self) -> bool:
+        """Drop one reader; returns True if it was the last and the stream was cut short."""
+        with self._cond:
+            self.readers -= 1
+            if self.readers or self.done:
+                return False
+            self.done = True
+            self._error = CancelledError()
+        if self._source is not None and hasattr(self._source, "close"):
+            self._source.close()
+        return True
+
+
+class StreamFlight:
+    """
+    Share one in-flight stream between concurrent callers with the same key.
+    The first caller opens it; callers arriving while it runs replay the
+    deltas produced so far and then follow it live. Whichever reader needs
+    the next delta pulls it from the source, so the stream keeps going if
+    the caller that opened it stops reading; it is closed once every
+    reader has gone. Works across threads.
+    """
+
+    def __init__(self):
+        self._streams = {}   # key -> _SharedStream
+        self._lock = threading.Lock()
+        self._stats = {"executions": 0, "coalesced": 0}
+
+    def _join(self, key, open_fn):
+        """Return (shared stream, is_leader) for `key`, registered as a reader."""
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is not None:
+                with shared._cond:
+                    if not shared.done:
+                        shared.readers += 1
+                        self._stats["coalesced"] += 1
+                        return shared, False
+            shared = _SharedStream(open_fn)
+            shared.readers = 1
+            self._streams[key] = shared
+            self._stats["executions"] += 1
+            return shared, True
+
+    def _finish(self, key, shared) -> None:
+        with self._lock:
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+
+    def stream(self, key, open_fn, on_join=None):
+        """
+        Yield the deltas of `open_fn()` (an iterable of text pieces), opened
+        once for all concurrent callers with the same `key`. `on_join(leader)`
+        is called once the caller knows whether it opened the stream.
+        """
+        shared, leader = self._join(key, open_fn)
+        if on_join:
+            on_join(leader)
+        try:
+            yield from shared.read()
+        finally:
+            shared.leave()
+            if shared.done:
+                self._finish(key, shared)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._streams)
+        return stats
@@ -1,36 +1,403 @@
+import json
 import os
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
+from utils import telemetry
+
+from utils.cache import TieredCache, make_key
+from utils.concurrency import AsyncLimiter, SingleFlight, StreamFlight
+from utils.router import Backend, Router
+from utils.tokens import count_message_tokens, count_tokens, get_context_window
+
 load_dotenv()
+telemetry.configure_from_env()
 
-_client = None
+_router = None
+_async_limiter = None
+_response_cache = None
+_summary_cache = None
+_extraction_cache = None
+_single_flight = SingleFlight()
+_stream_flight = StreamFlight()
 
-def get_client():
-    global _client
-    if _client is None:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("API key not found. Check your .env file.")
-        
+# Rough completion size reserved against the tokens-per-minute budget
+COMPLETION_TOKEN_ESTIMATE = 512
+
+def _load_backends():
+    """
+    Build the backend list. LLM_BACKENDS may hold a JSON list of
+    OpenAI-compatible endpoints, e.g.
+        [{"name": "groq", "provider": "groq", "api_key_env": "GROQ_API_KEY",
+          "model": "llama-3.3-70b-versatile", "rpm": 30},
+         {"name": "openai", "api_key_env": "OPENAI_API_KEY", "model": "gpt-4o-mini"}]
+    Without it, a single backend is built from OPENAI_API_KEY / GROQ_ENABLED /
+    OPENAI_MODEL / OPENAI_BASE_URL / LLM_RPM / LLM_TPM as before.
+    """
+    raw = os.getenv("LLM_BACKENDS", "").strip()
+    if raw:
+        specs = json.loads(raw)
+    else:
         use_groq = os.getenv("GROQ_ENABLED", "false").lower() == "true"
-        
-        if use_groq:
-            from groq import Groq
-            _client = Groq(api_key=api_key)
-        else:
-            from openai import OpenAI
-            _client = OpenAI(api_key=api_key)
-    
-    return _client
+        specs = [{
+            "name": "groq" if use_groq else "openai",
+            "provider": "groq" if use_groq else "openai",
+            "base_url": os.getenv("OPENAI_BASE_URL") or None,
+            "rpm": float(os.getenv("LLM_RPM", "0")),
+            "tpm": float(os.getenv("LLM_TPM", "0")),
+        }]
+
+    return [
+        Backend(
+            name=spec.get("name", f"backend-{i + 1}"),
+            api_key=spec.get("api_key") or os.getenv(spec.get("api_key_env", "OPENAI_API_KEY")),
+            model=spec.get("model") or get_model(),
+            provider=spec.get("provider", "openai"),
+            base_url=spec.get("base_url"),
+            rpm=float(spec.get("rpm", 0)),
+            tpm=float(spec.get("tpm", 0)),
+        )
+        for i, spec in enumerate(specs)
+    ]
+
+def get_router():
+    """
+    Shared backend router. Hedging is enabled by LLM_HEDGE_PERCENTILE
+    (e.g. 95 = duplicate a request once it runs slower than the backend's p95).
+    """
+    global _router
+    if _router is None:
+        hedge = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+        _router = Router(
+            _load_backends(),
+            hedge_percentile=hedge or None,
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "5")),
+        )
+    return _router
+
+def get_backend_stats():
+    """Rolling p50/p95 latency, error rate and health per backend."""
+    return get_router().stats()
+
+def get_client():
+    """Sync client of the preferred (first configured) backend."""
+    return get_router().backends[0].client()
+
+def get_async_client():
+    """Async client of the preferred backend for the running event loop."""
+    return get_router().backends[0].async_client()
+
+def get_async_limiter():
+    """Process-wide cap on in-flight async requests (LLM_MAX_CONCURRENCY, default 8)."""
+    global _async_limiter
+    if _async_limiter is None:
+        _async_limiter = AsyncLimiter(int(os.getenv("LLM_MAX_CONCURRENCY", "8")))
+    return _async_limiter
+
+def get_map_concurrency():
+    """Parallel LLM calls per map phase on the sync path (LLM_MAP_CONCURRENCY, default 4)."""
+    return max(1, int(os.getenv("LLM_MAP_CONCURRENCY", "4")))
+
+def estimate_tokens(messages):
+    """Prompt + expected completion tokens, reserved against rate-limit budgets."""
+    return count_message_tokens(messages, get_model()) + COMPLETION_TOKEN_ESTIMATE
+
+def get_input_budget(reserve_output=1024):
+    """
+    Max prompt tokens one request may use: the smallest context window across
+    configured backends minus `reserve_output`, also capped by any backend's
+    configured tokens-per-minute budget (a bigger request could never be
+    admitted) and by LLM_MAX_INPUT_TOKENS if set. Limits learned from
+    response headers are left out so chunking stays the same all process long.
+    """
+    limits = []
+    for backend in get_router().backends:
+        limits.append(get_context_window(backend.model) - reserve_output)
+        if backend.tpm > 0:
+            limits.append(int(backend.tpm) - reserve_output)
+    cap = os.getenv("LLM_MAX_INPUT_TOKENS", "").strip()
+    if cap:
+        limits.append(int(cap))
+    return max(256, min(limits))
+
+def _record_usage(backend, estimated, response):
+    telemetry.set_attributes(backend=backend.name)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        backend.limiter.record_usage(estimated, usage.total_tokens)
+        telemetry.set_attributes(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+        )
+
+def _create(messages, temperature, stream=False, **kwargs):
+    """Send one request via the router (rate limits, retries, failover, hedging)."""
+    estimated = estimate_tokens(messages)
+
+    def send(backend):
+        raw = backend.client().chat.completions.with_raw_response.create(
+            model=backend.model,
+            messages=messages,
+            temperature=temperature,
+            stream=stream,
+            **kwargs,
+        )
+        backend.limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        _record_usage(backend, estimated, response)
+        return response
+
+    return get_router().call(send, estimated, stream=stream)
+
+async def _acreate(messages, temperature, **kwargs):
+    """Async version of _create(); the concurrency slot is held only while sending."""
+    estimated = estimate_tokens(messages)
+
+    async def send(backend):
+        async with get_async_limiter():
+            raw = await backend.async_client().chat.completions.with_raw_response.create(
+                model=backend.model,
+                messages=messages,
+                temperature=temperature,
+                **kwargs,
+            )
+        backend.limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+        _record_usage(backend, estimated, response)
+        return response
+
+    return await get_router().acall(send, estimated)
 
 def get_model():
     return os.getenv("OPENAI_MODEL", "llama-3.3-70b-versatile")
 
-def chat_completion(messages, temperature=0.7):
-    client = get_client()
-    response = client.chat.completions.create(
-        model=get_model(),
-        messages=messages,
-        temperature=temperature,
-    )
-    return response.choices[0].message.content.strip()
\ No newline at end of file
+def get_response_cache():
+    """
+    Return the shared LLM response cache, or None if disabled.
+    Configured via LLM_CACHE_* environment variables:
+        LLM_CACHE_ENABLED   "true"/"false" (default true)
+        LLM_CACHE_DIR       disk tier folder, empty to keep memory-only (default .cache/llm)
+        LLM_CACHE_TTL       seconds before an entry expires (default 86400)
+        LLM_CACHE_MAX_ITEMS in-memory LRU size (default 512)
+        LLM_CACHE_MAX_MB    disk tier size cap (default 200)
+    """
+    global _response_cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _response_cache is None:
+        _response_cache = TieredCache(
+            directory=os.getenv("LLM_CACHE_DIR", ".cache/llm") or None,
+            ttl=float(os.getenv("LLM_CACHE_TTL", "86400")),
+            max_items=int(os.getenv("LLM_CACHE_MAX_ITEMS", "512")),
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024),
+        )
+    return _response_cache
+
+def get_summary_cache():
+    """
+    Persistent per-chunk summary memo, or None if caching is disabled.
+    Lets re-uploaded, lightly edited documents skip unchanged chunks.
+        LLM_SUMMARY_CACHE_DIR   disk folder (default .cache/summaries)
+        LLM_SUMMARY_CACHE_TTL   seconds before an entry expires (default 30 days)
+    """
+    global _summary_cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _summary_cache is None:
+        _summary_cache = TieredCache(
+            directory=os.getenv("LLM_SUMMARY_CACHE_DIR", ".cache/summaries") or None,
+            ttl=float(os.getenv("LLM_SUMMARY_CACHE_TTL", str(30 * 86400))),
+            max_items=1024,
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024),
+        )
+    return _summary_cache
+
+def get_extraction_cache():
+    """
+    Persistent cache of extracted document text, or None if disabled.
+    The same file uploaded on any page, by any session, is parsed once.
+        EXTRACT_CACHE_ENABLED   "true"/"false" (default true)
+        EXTRACT_CACHE_DIR       disk folder (default .cache/extract)
+        EXTRACT_CACHE_MAX_MB    disk size cap, least-recently-used first out (default 500)
+        EXTRACT_CACHE_MEMORY_MB size cap of the in-memory tier (default 64)
+    """
+    global _extraction_cache
+    if os.getenv("EXTRACT_CACHE_ENABLED", "true").lower() != "true":
+        return None
+    if _extraction_cache is None:
+        _extraction_cache = TieredCache(
+            directory=os.getenv("EXTRACT_CACHE_DIR", ".cache/extract") or None,
+            max_items=32,   # documents are large; keep only the hottest in memory
+            max_bytes=int(float(os.getenv("EXTRACT_CACHE_MAX_MB", "500")) * 1024 * 1024),
+            max_memory_bytes=int(float(os.getenv("EXTRACT_CACHE_MEMORY_MB", "64")) * 1024 * 1024),
+        )
+    return _extraction_cache
+
+def get_cache_stats():
+    """Hit/miss counters for the response cache (empty dict if disabled)."""
+    cache = get_response_cache()
+    return cache.stats() if cache else {}
+
+def get_single_flight_stats():
+    """How many provider calls ran vs. how many identical callers piggy-backed on them."""
+    return _single_flight.stats()
+
+def _single_flight_enabled():
+    return os.getenv("LLM_SINGLE_FLIGHT", "true").lower() == "true"
+
+def _cache_key(messages, temperature):
+    return make_key("chat_completion", get_model(), messages, temperature)
+
+def _cache_get(key):
+    cache = get_response_cache()
+    return cache.get(key) if cache else None
+
+def _cache_set(key, content):
+    cache = get_response_cache()
+    if cache:
+        cache.set(key, content)
+
+@contextmanager
+def _llm_span(name, temperature, use_cache):
+    """Trace one public LLM call and feed the per-feature latency metrics."""
+    current = None
+    try:
+        with telemetry.span(
+            name,
+            model=get_model(),
+            temperature=temperature,
+            cache="miss" if use_cache else "bypass",
+        ) as current:
+            yield current
+    finally:
+        if current is not None:
+            telemetry.record_llm_call(current)
+
+def _complete(messages, temperature):
+    response = _create(messages, temperature)
+    return response.choices[0].message.content.strip()
+
+async def _acomplete(messages, temperature):
+    response = await _acreate(messages, temperature)
+    return response.choices[0].message.content.strip()
+
+def chat_completion(messages, temperature=0.7, use_cache=True):
+    """
+    Send `messages` to the model and return the reply text.
+
+    With use_cache=True (the default) identical requests are answered from
+    the response cache, and concurrent identical requests — e.g. a whole
+    class generating the same quiz — share one in-flight provider call.
+    Pass use_cache=False to always get a fresh completion.
+    """
+    with _llm_span("llm.chat_completion", temperature, use_cache) as current:
+        if not use_cache:
+            return _complete(messages, temperature)
+
+        key = _cache_key(messages, temperature)
+        cached = _cache_get(key)
+        if cached is not None:
+            current.set(cache="hit")
+            return cached
+
+        def fetch():
+            # Only the caller that actually reaches the provider runs this
+            current.set(cache="miss")
+            content = _complete(messages, temperature)
+            _cache_set(key, content)
+            return content
+
+        if _single_flight_enabled():
+            current.set(cache="coalesced")
+            return _single_flight.do(key, fetch)
+        return fetch()
+
+async def achat_completion(messages, temperature=0.7, use_cache=True):
+    """Async version of chat_completion(), bounded by get_async_limiter()."""
+    with _llm_span("llm.achat_completion", temperature, use_cache) as current:
+        if not use_cache:
+            return await _acomplete(messages, temperature)
+
+        key = _cache_key(messages, temperature)
+        cached = _cache_get(key)
+        if cached is not None:
+            current.set(cache="hit")
+            return cached
+
+        async def fetch():
+            current.set(cache="miss")
+            content = await _acomplete(messages, temperature)
+            _cache_set(key, content)
+            return content
+
+        if _single_flight_enabled():
+            current.set(cache="coalesced")
+            return await _single_flight.ado(key, fetch)
+        return await fetch()
+
+def _stream_deltas(messages, temperature, key, usage):
+    """
+    Yield the text deltas of one provider stream; cache the full text at the
+    end. Token usage, if the provider reports it on a chunk, goes into `usage`.
+    """
+    # Retries cover opening the stream; a stream that breaks mid-way is not replayed
+    stream = _create(messages, temperature, stream=True)
+    parts = []
+    for chunk in stream:
+        reported = getattr(chunk, "usage", None)
+        if reported is not None:
+            usage.update(prompt_tokens=reported.prompt_tokens, completion_tokens=reported.completion_tokens)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+    if key and parts:
+        _cache_set(key, "".join(parts).strip())
+
+def stream_chat_completion(messages, temperature=0.7, use_cache=True):
+    """
+    Streaming version of chat_completion(): a generator yielding text
+    deltas as the model produces them. The full text is cached once the
+    stream finishes, and a cache hit is yielded as a single delta.
+    Concurrent identical streams share one provider call: callers that
+    arrive while it is in flight replay its deltas from the start.
+    Token usage is the provider's if it reports any, else counted locally.
+    """
+    with _llm_span("llm.stream_chat_completion", temperature, use_cache) as current:
+        key = _cache_key(messages, temperature) if use_cache else None
+        if key:
+            cached = _cache_get(key)
+            if cached is not None:
+                current.set(cache="hit")
+                yield cached
+                return
+
+        start = time.perf_counter()
+        usage, parts, coalesced = {}, [], False
+
+        def joined(leader):
+            nonlocal coalesced
+            coalesced = not leader
+            current.set(cache="miss" if leader else "coalesced")
+
+        if key and _single_flight_enabled():
+            deltas = _stream_flight.stream(key, lambda: _stream_deltas(messages, temperature, key, usage), on_join=joined)
+        else:
+            deltas = _stream_deltas(messages, temperature, key, usage)
+        try:
+            for delta in deltas:
+                if not parts:
+                    current.set(ttft_ms=round((time.perf_counter() - start) * 1000, 1))
+                parts.append(delta)
+                yield delta
+        finally:
+            # Only the caller that opened the stream is charged for it
+            if not coalesced and parts:
+                model = get_model()
+                current.set(
+                    prompt_tokens=usage.get("prompt_tokens") or count_message_tokens(messages, model),
+                    completion_tokens=usage.get("completion_tokens") or count_tokens("".join(parts), model),
+                )
@@ -0,0 +1,154 @@
+"""
+Utility: Offline extractive compression (no LLM calls).
+
+Sentences are scored with TF-IDF vectors and TextRank (PageRank over the
+sentence-similarity graph), vectorized with NumPy. Used to shrink long notes
+to a token budget before prompting ("fast" mode) and to build a summary
+without any provider call (offline mode).
+"""
+
+import re
+from collections import Counter
+
+import numpy as np
+
+from utils.tokens import count_tokens_batch
+
+
+# Token budget "fast" mode compresses documents down to
+FAST_MODE_TOKENS = 3000
+# Vocabulary kept for sentence vectors (most frequent terms)
+MAX_VOCABULARY = 4096
+# Above this many sentences the N×N graph gets expensive; score against the centroid instead
+MAX_GRAPH_SENTENCES = 1500
+# Sentences shorter than this are rarely worth keeping on their own
+MIN_SENTENCE_WORDS = 4
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])|\n{2,}|\n(?=\s*(?:[-*•]|\d+[.)])\s)")
+_PAGE_MARKER = re.compile(r"^--- Page \d+ ---$", re.MULTILINE)
+_WORD = re.compile(r"[A-Za-z][A-Za-z0-9'-]+")
+
+_STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being
+below between both but by can could did do does doing down during each few for from further had has
+have having he her here hers herself him himself his how i if in into is it its itself just let me
+more most my myself no nor not now of off on once only or other our ours ourselves out over own same
+she should so some such than that the their theirs them themselves then there these they this those
+through to too under until up us very was we were what when where which while who whom why will with
+would you your yours yourself yourselves one two may might must shall however thus therefore etc
+""".split())
+
+
+def split_sentences(text: str) -> list[str]:
+    """Split text into sentences (bullets and paragraphs count as sentences)."""
+    text = _PAGE_MARKER.sub("", text)
+    sentences = []
+    for part in _SENTENCE_SPLIT.split(text):
+        sentence = " ".join(part.split())
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def _terms(sentence: str) -> list[str]:
+    return [w for w in (m.lower() for m in _WORD.findall(sentence)) if w not in _STOPWORDS]
+
+
+def _tfidf_matrix(sentences: list[str]):
+    """Row-normalized TF-IDF matrix (sentences × vocabulary) and the vocabulary."""
+    tokenized = [_terms(s) for s in sentences]
+    doc_freq = Counter(term for terms in tokenized for term in set(terms))
+    vocabulary = [term for term, _ in doc_freq.most_common(MAX_VOCABULARY)]
+    index = {term: i for i, term in enumerate(vocabulary)}
+
+    matrix = np.zeros((len(sentences), len(vocabulary)), dtype=np.float32)
+    for row, terms in enumerate(tokenized):
+        for term, count in Counter(terms).items():
+            col = index.get(term)
+            if col is not None:
+                matrix[row, col] = count
+
+    idf = np.log((1 + len(sentences)) / (1 + np.array([doc_freq[t] for t in vocabulary], dtype=np.float32))) + 1
+    matrix = np.log1p(matrix) * idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-9), vocabulary
+
+
+def _textrank(vectors: np.ndarray, damping: float = 0.85, iterations: int = 30) -> np.ndarray:
+    similarity = vectors @ vectors.T
+    np.fill_diagonal(similarity, 0.0)
+    row_sums = similarity.sum(axis=1, keepdims=True)
+    # Isolated sentences link uniformly so the walk doesn't get stuck
+    transition = np.where(row_sums > 0, similarity / np.maximum(row_sums, 1e-9), 1.0 / len(vectors))
+    scores = np.full(len(vectors), 1.0 / len(vectors), dtype=np.float32)
+    for _ in range(iterations):
+        updated = (1 - damping) / len(vectors) + damping * (transition.T @ scores)
+        if np.abs(updated - scores).sum() < 1e-6:
+            return updated
+        scores = updated
+    return scores
+
+
+def score_sentences(sentences: list[str]) -> np.ndarray:
+    """Importance score per sentence (higher = more central to the document)."""
+    if not sentences:
+        return np.zeros(0, dtype=np.float32)
+    vectors, _ = _tfidf_matrix(sentences)
+    if len(sentences) <= MAX_GRAPH_SENTENCES:
+        scores = _textrank(vectors)
+    else:
+        centroid = vectors.mean(axis=0)
+        scores = vectors @ (centroid / max(np.linalg.norm(centroid), 1e-9))
+    lengths = np.array([len(s.split()) for s in sentences])
+    return np.where(lengths >= MIN_SENTENCE_WORDS, scores, scores * 0.1)
+
+
+def compress(text: str, max_tokens: int = FAST_MODE_TOKENS, model: str = "") -> str:
+    """
+    Shrink `text` to at most `max_tokens` by keeping its highest-scoring
+    sentences, in their original order. Text already within budget is
+    returned unchanged.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return text
+    sizes = count_tokens_batch(sentences, model)
+    if sum(sizes) <= max_tokens:
+        return text
+
+    scores = score_sentences(sentences)
+    keep, used = [], 0
+    for i in np.argsort(-scores, kind="stable"):
+        # +1 for the joining newline
+        if used + sizes[i] + 1 <= max_tokens:
+            keep.append(i)
+            used += sizes[i] + 1
+    return "\n".join(sentences[i] for i in sorted(keep))
+
+
+def key_terms(text: str, n: int = 10) -> list[str]:
+    """Most characteristic terms of `text` (TF-IDF weight summed over sentences)."""
+    sentences = split_sentences(text)
+    if not sentences:
+        return []
+    vectors, vocabulary = _tfidf_matrix(sentences)
+    if not vocabulary:
+        return []
+    weights = vectors.sum(axis=0)
+    return [vocabulary[i] for i in np.argsort(-weights)[:n]]
+
+
+def extractive_summary(text: str, max_sentences: int = 10) -> list[str]:
+    """The `max_sentences` most central sentences, in document order."""
+    sentences = split_sentences(text)
+    if len(sentences) <= max_sentences:
+        return sentences
+    scores = score_sentences(sentences)
+    top, seen = [], set()
+    for i in np.argsort(-scores, kind="stable"):
+        if sentences[i] not in seen:
+            seen.add(sentences[i])
+            top.append(i)
+            if len(top) == max_sentences:
+                break
+    return [sentences[i] for i in sorted(top)]
@@ -0,0 +1,152 @@
+"""
+Utility: Incremental JSON array parsing.
+
+Model replies for quizzes and flashcards are one JSON array. Feeding the
+reply to JSONArrayStream as it streams in yields each element the moment
+its closing brace arrives, so the UI can show the first item while the
+rest are still being generated. salvage_json_array() recovers the intact
+objects of a complete reply that is truncated or partly malformed.
+"""
+
+import json
+
+
+class JSONArrayStream:
+    """
+    Push parser for a single top-level JSON array.
+
+    Text before the opening "[" (e.g. a ```json fence) and after the
+    closing "]" is ignored. Only the element being read is buffered; each
+    one is decoded with json.loads() once it is complete. With
+    strict=False a malformed element is skipped (counted in `skipped`)
+    and a missing or unclosed array is not an error.
+
+    Usage:
+        parser = JSONArrayStream()
+        for delta in deltas:
+            for item in parser.feed(delta):
+                ...
+        parser.close()
+    """
+
+    def __init__(self, strict: bool = True):
+        self.strict = strict
+        self.depth = 0           # 0 = outside the array, 1 = between elements
+        self.started = False
+        self.finished = False
+        self.count = 0           # elements yielded so far
+        self.skipped = 0         # malformed or cut-off elements (strict=False)
+        self._in_string = False
+        self._escaped = False
+        self._element = []       # text of the element being read
+
+    def feed(self, text: str) -> list:
+        """Consume the next piece of the reply; returns the elements it completed."""
+        items = []
+        start = 0  # where the current element's text begins in `text`
+        for i, ch in enumerate(text):
+            if self.finished:
+                return items
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if self.depth == 0:
+                if ch == "[":
+                    self.depth = 1
+                    self.started = True
+                    start = i + 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self.depth += 1
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 1:
+                    # An object (or nested array) element just closed
+                    self._element.append(text[start:i + 1])
+                    start = i + 1
+                    self._take(items)
+                elif self.depth == 0:
+                    self._element.append(text[start:i])
+                    self._take(items)
+                    self.finished = True
+            elif ch == "," and self.depth == 1:
+                # Ends a scalar element; after an object the buffer is empty
+                self._element.append(text[start:i])
+                start = i + 1
+                self._take(items)
+
+        if self.depth >= 1:
+            self._element.append(text[start:])
+        return items
+
+    def close(self) -> None:
+        """
+        Raises:
+            ValueError: If no array was found or it never closed (truncated
+                reply), unless strict=False.
+        """
+        if not self.strict:
+            if not self.finished and "".join(self._element).strip():
+                self.skipped += 1  # the element the reply was cut off in
+            self._element = []
+            return
+        if not self.started:
+            raise ValueError("No JSON array found in the model response.")
+        if not self.finished:
+            raise ValueError(f"The model response ended before the JSON array was closed ({self.count} items read).")
+
+    def _take(self, items: list) -> None:
+        text = "".join(self._element).strip()
+        self._element = []
+        if not text:
+            return
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError as exc:
+            if not self.strict:
+                self.skipped += 1
+                return
+            raise ValueError(f"Malformed item in JSON array: {exc}\n{text[:200]}") from exc
+        self.count += 1
+        items.append(item)
+
+
+def salvage_json_array(text: str) -> tuple[list, int]:
+    """
+    Recover the objects of a JSON array from a whole reply that may be
+    truncated, hold a malformed object, or wrap the array in prose or
+    code fences. Scalars between the objects are dropped.
+
+    Returns:
+        (objects in order, number of fragments that could not be decoded)
+    """
+    start = text.find("[")
+    if start < 0:
+        return [], 0
+    try:
+        items = json.loads(text[start:text.rfind("]") + 1])
+        if isinstance(items, list):
+            return items, 0
+    except json.JSONDecodeError:
+        pass
+
+    # Decode object by object, resuming at the next "{" after a broken one
+    decoder = json.JSONDecoder()
+    items, broken, pos = [], 0, start + 1
+    while (brace := text.find("{", pos)) >= 0:
+        try:
+            item, pos = decoder.raw_decode(text, brace)
+        except json.JSONDecodeError:
+            broken += 1
+            pos = brace + 1
+            continue
+        items.append(item)
+    return items, broken
@@ -3,99 +3,1430 @@ Utilities for extracting text from uploaded files.
 Supports: PDF, DOCX, TXT
 """
 
+import codecs
+import hashlib
 import io
-from typing import Union
+import itertools
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, Union
+from xml.etree import ElementTree
 
+from utils.cache import make_key
+from utils.telemetry import span
+from utils.tokens import count_tokens_batch
 
-def extract_text_from_pdf(file_bytes: bytes) -> str:
+
+# Bump when extraction output changes so cached text is not reused
+EXTRACTOR_VERSION = 4
+
+# PDFs shorter than this are extracted in-process (pool start-up isn't worth it)
+PARALLEL_MIN_PAGES = 16
+# Fewest pages per worker task (each task re-opens the PDF)
+MIN_PAGES_PER_TASK = 4
+
+# Page quality thresholds for fast extraction (see page_quality_ok)
+MIN_PAGE_CHARS = 20
+MAX_BROKEN_WORD_RATIO = 0.3
+MAX_AVG_WORD_CHARS = 20
+MAX_GARBLED_RATIO = 0.05
+
+ENGINE_FAST = "pypdf2"
+ENGINE_LAYOUT = "pdfplumber"
+ENGINE_NONE = "none"
+
+# Bytes read or written per I/O call while ingesting uploads
+READ_BLOCK = 1 << 20
+# Extracted text held in memory before the output buffer spills to a temp file
+TEXT_BUFFER_BYTES = 8 << 20
+# Bytes sampled to guess the encoding of a text file that is not UTF-8
+ENCODING_SAMPLE_BYTES = 64 << 10
+# Below this share of non-ASCII bytes, non-UTF-8 text is taken as Windows-1252
+# (English notes with accents and smart quotes); above it, the encoding is guessed
+WESTERN_MAX_NON_ASCII = 0.1
+# A charset_normalizer guess is only taken when it reads this cleanly (chaos,
+# 0-1) and, if the bytes are also valid Windows-1252, this recognisably
+# (coherence, 0-1); short accented notes are otherwise misread
+GUESS_MAX_CHAOS = 0.1
+GUESS_MIN_COHERENCE = 0.2
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _pdf_workers() -> int:
+    """Worker processes for PDF extraction (PDF_WORKERS, default: CPU count up to 8)."""
+    return max(1, int(os.getenv("PDF_WORKERS", str(min(8, os.cpu_count() or 1)))))
+
+
+def _spool_threshold() -> int:
+    """Uploads larger than this (INGEST_SPOOL_MB, default 16) are parsed from a temp file."""
+    return int(float(os.getenv("INGEST_SPOOL_MB", "16")) * 1024 * 1024)
+
+
+def _get_pdf_pool(workers: int) -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # "spawn": forking the multi-threaded Streamlit server is unsafe
+            _pdf_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+
+def _reset_pdf_pool() -> None:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+def _open(source):
     """
-    Extract all text from a PDF file (as bytes).
-    Uses pdfplumber for best accuracy on complex layouts.
-    Falls back to PyPDF2 if pdfplumber fails.
+    A fresh stream per opener: bytes are wrapped as-is, and a spooled file
+    is memory-mapped so parsers read it through the page cache instead of
+    copying it into the process.
     """
-    text = ""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return io.BytesIO(source)
 
-    # Try pdfplumber first (better quality)
+
+def _blocks(source) -> Iterator:
+    """The source's bytes in READ_BLOCK pieces (memoryviews for in-memory sources: no copies)."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            while block := f.read(READ_BLOCK):
+                yield block
+    else:
+        view = memoryview(source)
+        for start in range(0, len(view), READ_BLOCK):
+            yield view[start:start + READ_BLOCK]
+
+
+def _read_range(source, start: int, length: int) -> bytes:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            f.seek(start)
+            return f.read(length)
+    return bytes(source[start:start + length])
+
+
+class _TextBuffer:
+    """Append-only text sink that spills to a temp file past TEXT_BUFFER_BYTES."""
+
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=TEXT_BUFFER_BYTES, mode="w+", encoding="utf-8", newline=""
+        )
+        self.chars = 0
+
+    def write(self, text: str) -> None:
+        self._file.write(text)
+        self.chars += len(text)
+
+    def getvalue(self) -> str:
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _open_plumber(source):
     try:
         import pdfplumber
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            pages_text = []
-            for i, page in enumerate(pdf.pages):
-                page_text = page.extract_text()
-                if page_text:
-                    pages_text.append(f"--- Page {i + 1} ---\n{page_text}")
-            text = "\n\n".join(pages_text)
-        if text.strip():
-            return text
+        return pdfplumber.open(_open(source))
     except Exception:
-        pass
+        return None
+
 
-    # Fallback to PyPDF2
+def page_quality_ok(text: str) -> bool:
+    """
+    Cheap check that fast (PyPDF2) output for a page is usable. Flags pages
+    that are (nearly) empty, letter-spaced ("T h e  c e l l"), missing word
+    breaks, or full of undecodable characters.
+    """
+    stripped = text.strip()
+    if len(stripped) < MIN_PAGE_CHARS:
+        return False
+    words = stripped.split()
+    broken = sum(1 for w in words if len(w) == 1 and w.isalpha() and w not in ("a", "A", "I"))
+    if broken / len(words) > MAX_BROKEN_WORD_RATIO:
+        return False
+    if len(stripped) / len(words) > MAX_AVG_WORD_CHARS:
+        return False
+    garbled = sum(1 for c in stripped if c == "\ufffd" or not (c.isprintable() or c.isspace()))
+    return garbled / len(stripped) <= MAX_GARBLED_RATIO
+
+
+class _PageExtractor:
+    """
+    Per-page adaptive extraction: PyPDF2 first, and pdfplumber (opened
+    lazily, once) only for pages whose fast output fails page_quality_ok().
+    `source` is a file path (in worker processes) or the PDF bytes.
+    """
+
+    def __init__(self, source):
+        import PyPDF2
+        self.source = source
+        self.reader = PyPDF2.PdfReader(_open(source))
+        self._plumber = None
+
+    @property
+    def page_count(self) -> int:
+        return len(self.reader.pages)
+
+    def page(self, index: int) -> tuple[str, str]:
+        """(text, engine) for the 0-based page `index`."""
+        try:
+            text = self.reader.pages[index].extract_text() or ""
+        except Exception:
+            text = ""
+        engine = ENGINE_FAST
+        if not page_quality_ok(text):
+            if self._plumber is None:
+                self._plumber = _open_plumber(self.source) or False
+            if self._plumber:
+                try:
+                    layout_text = self._plumber.pages[index].extract_text() or ""
+                except Exception:
+                    layout_text = ""
+                if layout_text.strip() or not text.strip():
+                    text, engine = layout_text, ENGINE_LAYOUT
+        return text, engine if text.strip() else ENGINE_NONE
+
+    def close(self) -> None:
+        if self._plumber:
+            self._plumber.close()
+        self._plumber = None
+
+
+def _iter_page_range(source, start: int, end: int) -> Iterator[tuple[str, str]]:
+    """Yield pages [start, end) as (text, engine) pairs."""
+    extractor = _PageExtractor(source)
+    try:
+        for i in range(start, end):
+            yield extractor.page(i)
+    finally:
+        extractor.close()
+
+
+def _extract_page_range(source, start: int, end: int) -> list[tuple[str, str]]:
+    """Worker-process entry point for _iter_page_range()."""
+    return list(_iter_page_range(source, start, end))
+
+
+def _iter_pages_parallel(source, page_count: int, workers: int) -> Iterator[tuple[str, str]]:
+    """
+    Run _extract_page_range() over page ranges in worker processes and yield
+    pages in order as their range finishes. Each worker memory-maps the PDF
+    from a shared file: the spooled upload, or a temp copy of in-memory bytes.
+    """
+    # A few ranges per worker so uneven pages (figures, tables) balance out,
+    # and the first pages arrive early for streaming consumers
+    size = max(MIN_PAGES_PER_TASK, math.ceil(page_count / (workers * 3)))
+    ranges = [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+    if isinstance(source, str):
+        path, owned = source, False
+    else:
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            tmp.write(source)
+        path, owned = tmp.name, True
+    futures = []
+    next_page = 0
+    try:
+        pool = _get_pdf_pool(workers)
+        futures = [pool.submit(_extract_page_range, path, start, end) for start, end in ranges]
+        for future in futures:
+            for page in future.result():
+                next_page += 1
+                yield page
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); finish in-process
+        _reset_pdf_pool()
+        yield from _iter_page_range(source, next_page, page_count)
+    finally:
+        for future in futures:
+            future.cancel()
+        if owned:
+            os.unlink(path)
+
+
+def _plumber_all_pages(source) -> Iterator[tuple[str, str]]:
+    """Whole-document pdfplumber pass, for PDFs PyPDF2 cannot open."""
+    import pdfplumber
+    with pdfplumber.open(_open(source)) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text() or ""
+            yield text, ENGINE_LAYOUT if text.strip() else ENGINE_NONE
+
+
+def iter_pdf_pages(source: Union[bytes, str]) -> Iterator[tuple[str, str]]:
+    """
+    Yield (text, engine) for every page of a PDF (bytes or a file path), in
+    order, as soon as each is extracted. Long documents are spread over
+    PDF_WORKERS processes.
+    """
     try:
         import PyPDF2
-        reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-        pages_text = []
-        for i, page in enumerate(reader.pages):
-            page_text = page.extract_text()
-            if page_text:
-                pages_text.append(f"--- Page {i + 1} ---\n{page_text}")
-        text = "\n\n".join(pages_text)
-    except Exception as e:
-        raise RuntimeError(f"Could not extract text from PDF: {e}")
+        page_count = len(PyPDF2.PdfReader(_open(source)).pages)
+    except Exception:
+        yield from _plumber_all_pages(source)
+        return
+
+    workers = _pdf_workers() if page_count >= PARALLEL_MIN_PAGES else 1
+    if workers > 1:
+        yield from _iter_pages_parallel(source, page_count, workers)
+    else:
+        yield from _iter_page_range(source, 0, page_count)
 
-    return text
 
+def _iter_page_pieces(source) -> Iterator[tuple[str, str]]:
+    """("--- Page N ---\n<text>", engine) for each page with text; engine for every page."""
+    for number, (page_text, engine) in enumerate(iter_pdf_pages(source), start=1):
+        yield (f"--- Page {number} ---\n{page_text}" if page_text else ""), engine
 
-def extract_text_from_docx(file_bytes: bytes) -> str:
-    """Extract text from a DOCX file."""
+
+def extract_pdf_with_report(source: Union[bytes, str]) -> tuple[str, dict]:
+    """
+    Extract all text from a PDF file (bytes or a file path), choosing the
+    engine per page. Pages are written to a bounded buffer rather than kept
+    as a list and joined.
+
+    Returns:
+        (text, report) where report is
+            {"pages": int, "engines": {engine: [page numbers]}}
+        and engine is "pypdf2", "pdfplumber" or "none" (no text found).
+    """
+    buffer = _TextBuffer()
+    engines = {}
+    with span("extract.pdf") as current:
+        try:
+            for number, (piece, engine) in enumerate(_iter_page_pieces(source), start=1):
+                engines.setdefault(engine, []).append(number)
+                if piece:
+                    buffer.write("\n\n" + piece if buffer.chars else piece)
+            text = buffer.getvalue()
+        except Exception as e:
+            raise RuntimeError(f"Could not extract text from PDF: {e}")
+        finally:
+            buffer.close()
+        pages = sum(len(numbers) for numbers in engines.values())
+        current.set(pages=pages, **{f"{engine}_pages": len(numbers) for engine, numbers in engines.items()})
+    return text, {"pages": pages, "engines": engines}
+
+
+def extract_text_from_pdf(source: Union[bytes, str]) -> str:
+    """
+    Extract all text from a PDF file (bytes or a file path).
+    Uses fast PyPDF2 extraction per page and re-extracts only poor-quality
+    pages with pdfplumber; long documents are spread over PDF_WORKERS processes.
+    """
+    return extract_pdf_with_report(source)[0]
+
+
+_DOCX_NS = {
+    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "ep": "http://schemas.openxmlformats.org/officeDocument/2006/extended-properties",
+    "rel": "http://schemas.openxmlformats.org/package/2006/relationships",
+}
+_W = "{%s}" % _DOCX_NS["w"]
+
+# Blocks produced by _iter_docx_blocks()
+BLOCK_HEADING = "heading"
+BLOCK_PARAGRAPH = "paragraph"
+BLOCK_ITEM = "item"
+BLOCK_ROW = "row"
+BLOCK_PAGE = "page"
+# Text of a BLOCK_PAGE that falls inside a paragraph (the next block continues it)
+_PAGE_INSIDE = "inside"
+
+# Package problems the streaming parser gives up on (python-docx gets a try)
+_DOCX_PARSE_ERRORS = (zipfile.BadZipFile, KeyError, ElementTree.ParseError)
+
+
+def _zip_source(source):
+    # zipfile needs a seekable file object (not an mmap): pass a path as-is
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+
+def _docx_main_part(archive: zipfile.ZipFile) -> str:
+    """Name of the main document part (almost always word/document.xml)."""
+    rels = ElementTree.fromstring(archive.read("_rels/.rels"))
+    for rel in rels.iter("{%s}Relationship" % _DOCX_NS["rel"]):
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target", "").lstrip("/")
+    return "word/document.xml"
+
+
+def _outline_level(props):
+    """Heading level (1-based) from a w:outlineLvl under `props`, if any (9 = body text)."""
+    outline = props.find(_W + "outlineLvl") if props is not None else None
+    value = outline.get(_W + "val", "") if outline is not None else ""
+    return int(value) + 1 if value.isdigit() and int(value) < 9 else None
+
+
+def _docx_styles(archive: zipfile.ZipFile) -> tuple[dict, set]:
+    """
+    From word/styles.xml: styleId -> heading level (by style name or
+    outline level), and the styleIds of list styles (numbered/bulleted).
+    """
+    levels, lists = {}, set()
+    if "word/styles.xml" not in archive.namelist():
+        return levels, lists
+    for style in ElementTree.fromstring(archive.read("word/styles.xml")).iter(_W + "style"):
+        style_id = style.get(_W + "styleId")
+        name_el = style.find(_W + "name")
+        name = name_el.get(_W + "val", "").lower() if name_el is not None else ""
+        heading = re.fullmatch(r"heading (\d)", name)
+        level = 1 if name == "title" else int(heading.group(1)) if heading else _outline_level(style.find(_W + "pPr"))
+        if level:
+            levels[style_id] = level
+        elif style.find(f"{_W}pPr/{_W}numPr") is not None or name.startswith(("list bullet", "list number")):
+            lists.add(style_id)
+    return levels, lists
+
+
+def _docx_runs(p) -> list[str]:
+    """Text of a w:p element, split at its page breaks (one more piece than breaks)."""
+    pieces, parts = [], []
+    for run in p.iter(_W + "r"):
+        for el in run:
+            tag = el.tag
+            if tag == _W + "t":
+                parts.append(el.text or "")
+            elif tag == _W + "tab":
+                parts.append("\t")
+            elif tag in (_W + "br", _W + "cr"):
+                if el.get(_W + "type") == "page":
+                    pieces.append("".join(parts))
+                    parts = []
+                else:
+                    parts.append("\n")
+            elif tag == _W + "lastRenderedPageBreak":
+                pieces.append("".join(parts))
+                parts = []
+            elif tag == _W + "noBreakHyphen":
+                parts.append("-")
+    pieces.append("".join(parts))
+    return pieces
+
+
+def _docx_paragraph(p, heading_levels: dict, list_styles: set) -> tuple[str, list[str]]:
+    """(block kind, text pieces between page breaks) for a w:p element."""
+    pieces = _docx_runs(p)
+    props = p.find(_W + "pPr")
+    if props is None:
+        return BLOCK_PARAGRAPH, pieces
+    style = props.find(_W + "pStyle")
+    style_id = style.get(_W + "val") if style is not None else None
+    level = _outline_level(props) or heading_levels.get(style_id)
+    if level:
+        kind, prefix = BLOCK_HEADING, "#" * min(level, 6) + " "
+    elif props.find(_W + "numPr") is not None or style_id in list_styles:
+        kind, prefix = BLOCK_ITEM, "- "
+    else:
+        return BLOCK_PARAGRAPH, pieces
+    filled = [i for i, text in enumerate(pieces) if text.strip()]
+    if filled:
+        pieces[filled[-1]] = pieces[filled[-1]].rstrip()
+        pieces[filled[0]] = prefix + pieces[filled[0]].lstrip()
+    return kind, pieces
+
+
+def _paragraph_blocks(kind: str, pieces: list[str]) -> Iterator[tuple[str, str]]:
+    """The blocks of one paragraph: its text, with BLOCK_PAGE where its page breaks fall."""
+    started = False
+    for i, text in enumerate(pieces):
+        filled = bool(text.strip())
+        if i:
+            yield BLOCK_PAGE, _PAGE_INSIDE if started and filled else ""
+        if filled:
+            yield kind, text
+            started = True
+
+
+def _iter_docx_blocks(source) -> Iterator[tuple[str, str]]:
+    """
+    Stream (kind, text) blocks from a DOCX in document order without
+    building an object model: the main part is iterparsed straight from
+    the zip and each top-level element is discarded once read.
+
+    Headings come out as "# Title" / "## Section" (chunk boundaries), list
+    items as "- item", table rows as "| cell | cell |", and BLOCK_PAGE
+    marks explicit and last-rendered page breaks.
+    """
+    with zipfile.ZipFile(_zip_source(source)) as archive:
+        heading_levels, list_styles = _docx_styles(archive)
+        with archive.open(_docx_main_part(archive)) as xml:
+            body, depth = None, 0
+            tables = []     # open w:tbl elements: {"row": [cells], "cell": [paragraph texts]}
+            for event, el in ElementTree.iterparse(xml, events=("start", "end")):
+                tag = el.tag
+                if event == "start":
+                    depth += 1
+                    if tag == _W + "body":
+                        body = el
+                    elif tag == _W + "tbl":
+                        tables.append({"row": None, "cell": None})
+                    elif tag == _W + "tr" and tables:
+                        tables[-1]["row"] = []
+                    elif tag == _W + "tc" and tables:
+                        tables[-1]["cell"] = []
+                    continue
+
+                if tag == _W + "p":
+                    kind, pieces = _docx_paragraph(el, heading_levels, list_styles)
+                    if tables and tables[-1]["cell"] is not None:
+                        text = " ".join(" ".join(pieces).split())
+                        if text:
+                            tables[-1]["cell"].append(text)
+                    else:
+                        yield from _paragraph_blocks(kind, pieces)
+                    el.clear()
+                elif tag == _W + "tc" and tables and tables[-1]["row"] is not None:
+                    tables[-1]["row"].append(" ".join(tables[-1]["cell"] or []))
+                    tables[-1]["cell"] = None
+                elif tag == _W + "tr" and tables:
+                    row, tables[-1]["row"] = tables[-1]["row"] or [], None
+                    if any(row):
+                        if len(tables) > 1 and tables[-2]["cell"] is not None:
+                            # Nested table: its rows become text of the outer cell
+                            tables[-2]["cell"].append(" ".join(c for c in row if c))
+                        else:
+                            yield BLOCK_ROW, "| " + " | ".join(c.replace("|", "/") for c in row) + " |"
+                elif tag == _W + "tbl" and tables:
+                    tables.pop()
+
+                depth -= 1
+                if body is not None and depth == 2:
+                    # A top-level block is done: drop it so memory stays flat
+                    body.clear()
+
+
+def _iter_docx_blocks_fallback(source) -> Iterator[tuple[str, str]]:
+    """python-docx paragraphs, for packages the streaming parser cannot read."""
+    from docx import Document as DocxDocument
+    for para in DocxDocument(_zip_source(source)).paragraphs:
+        yield from _paragraph_blocks(BLOCK_PARAGRAPH, _docx_runs(para._p))
+
+
+def _block_separator(previous: str, kind: str) -> str:
+    # Rows of a table and items of a list stay together; other blocks are paragraphs
+    return "\n" if previous == kind and kind in (BLOCK_ROW, BLOCK_ITEM) else "\n\n"
+
+
+def _write_docx(blocks, buffer: _TextBuffer) -> None:
+    previous, inside = None, False
+    for kind, text in blocks:
+        if kind == BLOCK_PAGE:
+            # A paragraph that runs over a page stays one paragraph
+            inside = text == _PAGE_INSIDE
+            continue
+        if buffer.chars and not inside:
+            buffer.write(_block_separator(previous, kind))
+        inside = False
+        buffer.write(text)
+        previous = kind
+
+
+def extract_text_from_docx(source: Union[bytes, str]) -> str:
+    """
+    Extract text from a DOCX file (bytes or a file path), streaming the
+    document XML (see _iter_docx_blocks) and falling back to python-docx
+    for packages it cannot read.
+    """
+    buffer = _TextBuffer()
     try:
-        from docx import Document
-        doc = Document(io.BytesIO(file_bytes))
-        paragraphs = [para.text for para in doc.paragraphs if para.text.strip()]
-        return "\n".join(paragraphs)
+        try:
+            _write_docx(_iter_docx_blocks(source), buffer)
+        except _DOCX_PARSE_ERRORS:
+            buffer.close()
+            buffer = _TextBuffer()
+            _write_docx(_iter_docx_blocks_fallback(source), buffer)
+        return buffer.getvalue()
     except Exception as e:
         raise RuntimeError(f"Could not extract text from DOCX: {e}")
+    finally:
+        buffer.close()
 
 
-def extract_text_from_txt(file_bytes: bytes) -> str:
-    """Decode a plain text file."""
+def _docx_pages(source) -> list[str]:
+    """Text of each page, split at explicit and last-rendered page breaks."""
+    def collect(blocks):
+        pages, current, previous = [], [], None
+        for kind, text in blocks:
+            if kind == BLOCK_PAGE:
+                if current:
+                    pages.append("".join(current))
+                    current, previous = [], None
+                continue
+            if current:
+                current.append(_block_separator(previous, kind))
+            current.append(text)
+            previous = kind
+        pages.append("".join(current))
+        return pages
+
     try:
-        return file_bytes.decode("utf-8")
+        return collect(_iter_docx_blocks(source))
+    except _DOCX_PARSE_ERRORS:
+        return collect(_iter_docx_blocks_fallback(source))
+
+
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+
+def _guess_encoding(sample: bytes) -> str:
+    """Encoding of non-UTF-8 text: Windows-1252, a confident charset_normalizer guess, or Latin-1."""
+    if sum(byte > 0x7F for byte in sample) <= WESTERN_MAX_NON_ASCII * len(sample):
+        return "cp1252"
+    try:
+        sample.decode("cp1252")
+        fallback = "cp1252"
     except UnicodeDecodeError:
-        return file_bytes.decode("latin-1")
+        fallback = "latin-1"
+    try:
+        from charset_normalizer import from_bytes
+    except ImportError:
+        return fallback
 
+    matches = from_bytes(sample)
+    best = matches.best()
+    if best is None or best.encoding in ("ascii", "utf_8") or best.chaos > GUESS_MAX_CHAOS:
+        return fallback
+    if fallback == "cp1252":
+        # Western text fits several Latin code pages equally well; keep Windows-1252
+        # unless the guess reads clearly better and is recognisably a language
+        if any(m.encoding == "cp1252" and m.chaos <= best.chaos for m in matches):
+            return fallback
+        if best.coherence < GUESS_MIN_COHERENCE:
+            return fallback
+    return best.encoding
 
-def extract_text(uploaded_file) -> str:
+
+def _decode_into(source, encoding: str, buffer: _TextBuffer, errors: str = "strict") -> None:
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    offset = 0
+    for block in _blocks(source):
+        try:
+            buffer.write(decoder.decode(block))
+        except UnicodeDecodeError as e:
+            e.start += offset
+            raise
+        offset += len(block)
+    buffer.write(decoder.decode(b"", final=True))
+
+
+def extract_text_from_txt(source: Union[bytes, str]) -> str:
     """
-    Auto-detect file type from a Streamlit UploadedFile object
-    and return extracted text.
+    Decode a plain text file (bytes or a file path) block by block: a BOM
+    decides the encoding, otherwise UTF-8, otherwise a guess from the bytes
+    around the first invalid sequence.
     """
+    head = _read_range(source, 0, 4)
+    encoding = next((name for bom, name in _BOMS if head.startswith(bom)), "utf-8")
+    buffer = _TextBuffer()
+    try:
+        try:
+            _decode_into(source, encoding, buffer)
+        except UnicodeDecodeError as e:
+            buffer.close()
+            buffer = _TextBuffer()
+            sample = _read_range(source, max(0, e.start - ENCODING_SAMPLE_BYTES // 2), ENCODING_SAMPLE_BYTES)
+            _decode_into(source, _guess_encoding(sample), buffer, errors="replace")
+        return buffer.getvalue()
+    finally:
+        buffer.close()
+
+
+def _file_type(uploaded_file) -> str:
     name = uploaded_file.name.lower()
-    file_bytes = uploaded_file.read()
-
-    if name.endswith(".pdf"):
-        return extract_text_from_pdf(file_bytes)
-    elif name.endswith(".docx"):
-        return extract_text_from_docx(file_bytes)
-    elif name.endswith(".txt"):
-        return extract_text_from_txt(file_bytes)
-    else:
+    file_type = name.rsplit(".", 1)[-1]
+    if file_type not in ("pdf", "docx", "txt"):
         raise ValueError(f"Unsupported file type: {uploaded_file.name}. Please upload PDF, DOCX, or TXT.")
+    return file_type
+
 
+def _upload_digest(uploaded_file) -> str:
+    # getvalue() of an in-memory upload shares its buffer: hashing it copies nothing
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
 
-def chunk_text(text: str, max_tokens: int = 3000, overlap: int = 200) -> list[str]:
+
+def _upload_size(uploaded_file) -> int:
+    size = getattr(uploaded_file, "size", None)
+    return size if size is not None else len(uploaded_file.getvalue())
+
+
+def _extraction_cache_key(digest: str, file_type: str) -> str:
+    return make_key("extract", EXTRACTOR_VERSION, file_type, digest)
+
+
+@contextmanager
+def _spooled(uploaded_file, file_type: str):
+    """
+    Parse source for an upload: its bytes when small, otherwise a temp file
+    (written block by block, memory-mapped by the parsers and shared with
+    PDF worker processes) that is removed afterwards.
+    """
+    if _upload_size(uploaded_file) <= _spool_threshold():
+        yield uploaded_file.getvalue()
+        return
+    with tempfile.NamedTemporaryFile(suffix=f".{file_type}", delete=False) as tmp:
+        uploaded_file.seek(0)
+        shutil.copyfileobj(uploaded_file, tmp, READ_BLOCK)
+        uploaded_file.seek(0)
+    try:
+        yield tmp.name
+    finally:
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            # Still mapped by a parser on a platform that forbids this; the OS cleans temp later
+            pass
+
+
+def _extraction_cache():
+    # Imported here so PDF worker processes don't run config's telemetry setup
+    from utils.config import get_extraction_cache
+    return get_extraction_cache()
+
+
+def cached_text(uploaded_file):
+    """Previously extracted text for this file, or None (never parses)."""
+    cache = _extraction_cache()
+    if cache is None:
+        return None
+    return cache.get(_extraction_cache_key(_upload_digest(uploaded_file), _file_type(uploaded_file)))
+
+
+def extract_text(uploaded_file) -> str:
+    """
+    Auto-detect file type from a Streamlit UploadedFile object
+    and return extracted text. Results are cached by file content, so
+    re-uploading the same file anywhere returns instantly. Large uploads
+    are parsed from a spooled temp file (see _spooled).
+    """
+    file_type = _file_type(uploaded_file)
+    digest = _upload_digest(uploaded_file)
+
+    with span("extract", feature="extraction", file_type=file_type, bytes=_upload_size(uploaded_file)) as current:
+        cache = _extraction_cache()
+        key = _extraction_cache_key(digest, file_type)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                current.set(cache="hit", chars=len(cached))
+                return cached
+
+        with _spooled(uploaded_file, file_type) as source:
+            current.set(spooled=isinstance(source, str))
+            if file_type == "pdf":
+                text = extract_text_from_pdf(source)
+            elif file_type == "docx":
+                text = extract_text_from_docx(source)
+            else:
+                text = extract_text_from_txt(source)
+        current.set(cache="miss", chars=len(text))
+        if cache is not None:
+            cache.set(key, text)
+        return text
+
+
+def stream_text(uploaded_file) -> Iterator[str]:
     """
-    Split text into chunks of roughly max_tokens words with overlap.
-    This prevents hitting the LLM context window limit for long documents.
+    Like extract_text(), but yields the text in pieces — PDF pages as soon
+    as they are extracted — so downstream work can start before the whole
+    file is parsed. "\n\n".join(pieces) equals extract_text(); the full
+    text is cached once the stream has been read to the end.
     """
-    words = text.split()
-    chunks = []
-    start = 0
+    file_type = _file_type(uploaded_file)
+    cache = _extraction_cache()
+    key = _extraction_cache_key(_upload_digest(uploaded_file), file_type)
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        yield cached
+        return
+    if file_type != "pdf":
+        yield extract_text(uploaded_file)
+        return
+
+    buffer = _TextBuffer()
+    try:
+        with _spooled(uploaded_file, file_type) as source:
+            pages = _iter_page_pieces(source)
+            for number in itertools.count(1):
+                # One span per page: a span held open across the yields would
+                # become the parent of whatever the consumer traces meanwhile
+                with span("extract.page", feature="extraction", page=number, mode="stream") as current:
+                    try:
+                        piece, _ = next(pages, (None, None))
+                    except Exception as e:
+                        raise RuntimeError(f"Could not extract text from PDF: {e}")
+                    current.set(chars=len(piece or ""))
+                if piece is None:
+                    break
+                if piece:
+                    buffer.write("\n\n" + piece if buffer.chars else piece)
+                    yield piece
+        if cache is not None:
+            cache.set(key, buffer.getvalue())
+    finally:
+        buffer.close()
+
+
+# ─────────────────────────────────────────────
+# PAGE-ADDRESSABLE DOCUMENTS
+# ─────────────────────────────────────────────
+
+# Documents kept open (with their memoized pages) across reruns and sessions
+OPEN_DOCUMENTS = 8
+
+_open_documents = OrderedDict()
+_open_documents_lock = threading.Lock()
+
+
+def _open_documents_budget() -> int:
+    """Bytes the open documents may hold in total (OPEN_DOCUMENTS_MB, default 64)."""
+    return int(float(os.getenv("OPEN_DOCUMENTS_MB", "64")) * 1024 * 1024)
+
+
+def _docx_metadata(file_bytes: bytes) -> dict:
+    """Title/author/page count from the DOCX property parts (no body parsing)."""
+    metadata = {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_bytes)) as archive:
+            names = set(archive.namelist())
+            if "docProps/core.xml" in names:
+                core = ElementTree.fromstring(archive.read("docProps/core.xml"))
+                for key, path in (("title", "dc:title"), ("author", "dc:creator"), ("subject", "dc:subject")):
+                    value = core.findtext(path, namespaces=_DOCX_NS)
+                    if value:
+                        metadata[key] = value
+            if "docProps/app.xml" in names:
+                app = ElementTree.fromstring(archive.read("docProps/app.xml"))
+                pages = app.findtext("ep:Pages", namespaces=_DOCX_NS)
+                if pages and pages.isdigit():
+                    metadata["rendered_pages"] = int(pages)
+    except (zipfile.BadZipFile, ElementTree.ParseError, KeyError):
+        pass
+    return metadata
+
+
+class Document:
+    """
+    A lazily opened PDF/DOCX/TXT whose pages are extracted only when asked
+    for, and memoized per page.
+
+        doc = open_document(uploaded_file)
+        doc.page_count, doc.metadata      # PDF: cheap, no text extraction
+        doc.text([3, 4])                  # parses pages 3 and 4 only
+
+    DOCX files are paged at explicit and last-rendered page breaks, which
+    takes one streamed parse of the body: it runs on first use (page count
+    or text) and its pages are kept, so doc.text() of the whole file does
+    not parse it again. TXT files are a single page.
+    """
+
+    def __init__(self, file_bytes: bytes, name: str):
+        self.name = name
+        self.file_type = name.lower().rsplit(".", 1)[-1]
+        if self.file_type not in ("pdf", "docx", "txt"):
+            raise ValueError(f"Unsupported file type: {name}. Please upload PDF, DOCX, or TXT.")
+        self._bytes = file_bytes
+        self._pages = {}      # 1-based page number -> text
+        self.engines = {}     # 1-based page number -> engine (PDF only)
+        self._extractor = None
+        self._docx_pages = None
+        self._metadata = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_upload(cls, uploaded_file) -> "Document":
+        return cls(uploaded_file.getvalue(), uploaded_file.name)
+
+    def _pdf(self) -> _PageExtractor:
+        if self._extractor is None:
+            try:
+                self._extractor = _PageExtractor(self._bytes)
+            except Exception as e:
+                raise RuntimeError(f"Could not open PDF: {e}")
+        return self._extractor
+
+    def _docx(self) -> list[str]:
+        if self._docx_pages is None:
+            try:
+                self._docx_pages = _docx_pages(self._bytes)
+            except Exception as e:
+                raise RuntimeError(f"Could not extract text from DOCX: {e}")
+        return self._docx_pages
+
+    @property
+    def page_count(self) -> int:
+        with self._lock:
+            if self.file_type == "pdf":
+                return self._pdf().page_count
+            if self.file_type == "docx":
+                return len(self._docx())
+            return 1
+
+    @property
+    def metadata(self) -> dict:
+        """Title, author etc. where the file records them, plus the page count."""
+        with self._lock:
+            if self._metadata is None:
+                metadata = {}
+                if self.file_type == "pdf":
+                    info = self._pdf().reader.metadata or {}
+                    for key, field in (("title", "/Title"), ("author", "/Author"),
+                                       ("subject", "/Subject"), ("creator", "/Creator")):
+                        if info.get(field):
+                            metadata[key] = str(info[field])
+                elif self.file_type == "docx":
+                    metadata = _docx_metadata(self._bytes)
+                self._metadata = metadata
+        return {**self._metadata, "pages": self.page_count}
+
+    def page_text(self, number: int) -> str:
+        """Text of 1-based page `number`, extracted on first use."""
+        if not 1 <= number <= self.page_count:
+            raise ValueError(f"Page {number} is out of range (1-{self.page_count}).")
+        with self._lock:
+            if number not in self._pages:
+                if self.file_type == "pdf":
+                    with span("extract.page", feature="extraction", page=number):
+                        text, engine = self._pdf().page(number - 1)
+                    self.engines[number] = engine
+                elif self.file_type == "docx":
+                    text = self._docx()[number - 1]
+                else:
+                    text = extract_text_from_txt(self._bytes)
+                self._pages[number] = text
+            return self._pages[number]
+
+    def text(self, pages: Iterable[int] = None) -> str:
+        """
+        Text of the selected pages (default: all), formatted like
+        extract_text(): PDF pages carry "--- Page N ---" markers.
+        """
+        numbers = list(pages) if pages is not None else list(range(1, self.page_count + 1))
+        texts = [(n, self.page_text(n)) for n in numbers]
+        if self.file_type == "pdf":
+            return "\n\n".join(f"--- Page {n} ---\n{t}" for n, t in texts if t)
+        return "\n\n".join(t for _, t in texts if t)
+
+    @property
+    def size(self) -> int:
+        """Approximate bytes held: the file plus the text extracted so far."""
+        with self._lock:
+            pages = self._docx_pages or list(self._pages.values())
+            return len(self._bytes) + sum(len(text) for text in pages)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._extractor is not None:
+                self._extractor.close()
+
+
+def open_document(uploaded_file) -> Document:
+    """
+    Document for an uploaded file, shared by content hash so its memoized
+    pages survive Streamlit reruns and are reused across pages and sessions.
+    At most OPEN_DOCUMENTS are kept, holding at most OPEN_DOCUMENTS_MB
+    between them (the newest one is always kept).
+    """
+    file_bytes = uploaded_file.getvalue()
+    key = (hashlib.sha256(file_bytes).hexdigest(), uploaded_file.name.lower().rsplit(".", 1)[-1])
+    with _open_documents_lock:
+        doc = _open_documents.get(key)
+        if doc is not None:
+            _open_documents.move_to_end(key)
+            return doc
+    doc = Document(file_bytes, uploaded_file.name)
+    with _open_documents_lock:
+        doc = _open_documents.setdefault(key, doc)
+        _open_documents.move_to_end(key)
+        budget, held = _open_documents_budget(), sum(d.size for d in _open_documents.values())
+        while len(_open_documents) > 1 and (len(_open_documents) > OPEN_DOCUMENTS or held > budget):
+            _, evicted = _open_documents.popitem(last=False)
+            held -= evicted.size
+            evicted.close()
+    return doc
+
+
+# ─────────────────────────────────────────────
+# BOILERPLATE AND NEAR-DUPLICATE PAGES
+# ─────────────────────────────────────────────
+
+# Lines at the top and bottom of a page checked for running headers/footers
+EDGE_LINES = 3
+# An edge line is boilerplate once it was seen on this many earlier pages...
+BOILERPLATE_MIN_PAGES = 2
+# ...and on at least this share of them
+BOILERPLATE_PAGE_RATIO = 0.5
+# A page this much contained in a neighbour is dropped (slide build-ups, repeated slides)
+NEAR_DUPLICATE_CONTAINMENT = 0.9
+# Earlier kept pages a new page is compared against
+NEAR_DUPLICATE_WINDOW = 8
+# MinHash signature size and shingle length (words)
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 5
+
+_MARKER_SPLIT = re.compile(r"^--- Page \d+ ---[ \t]*\n?", re.MULTILINE)
+_DIGITS = re.compile(r"\d+")
+# Page counters: "12", "- 12 -", "Page 3 of 40", "Slide 7/20"
+_PAGE_COUNTER = re.compile(r"[\W_]*(?:(?:page|pg|p|slide)\.?\s*)?\d+(?:\s*(?:of|/)\s*\d+)?[\W_]*", re.IGNORECASE)
+_MINHASH_PRIME = 4294967291  # largest prime below 2**32
+
+
+def _line_signature(line: str) -> str:
+    signature = " ".join(line.lower().split())
+    # Page counters change on every page; other lines must repeat exactly
+    # (so "Chapter 4" is not mistaken for last page's "Chapter 3")
+    return _DIGITS.sub("#", signature) if _PAGE_COUNTER.fullmatch(signature) else signature
+
+
+def _minhash(text: str):
+    """(signature, distinct shingle count) of a page, or None if it has no words."""
+    import numpy as np
+    words = " ".join(_line_signature(line) for line in text.split("\n")).split()
+    if not words:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    a, b = _minhash_params()
+    signature = ((a[:, None] * hashes[None, :] + b[:, None]) % _MINHASH_PRIME).min(axis=1)
+    return signature, len(shingles)
+
 
-    while start < len(words):
-        end = start + max_tokens
-        chunk = " ".join(words[start:end])
-        chunks.append(chunk)
-        start = end - overlap  # overlap for context continuity
+_minhash_cache = []
 
-    return chunks
+
+def _minhash_params():
+    if not _minhash_cache:
+        import numpy as np
+        rng = np.random.default_rng(20240601)
+        _minhash_cache.append((
+            rng.integers(1, _MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+            rng.integers(0, _MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+        ))
+    return _minhash_cache[0]
+
+
+def _containment(inner, outer) -> float:
+    """Estimated share of `inner`'s shingles that also occur in `outer`."""
+    (sig_a, size_a), (sig_b, size_b) = inner, outer
+    jaccard = float((sig_a == sig_b).mean())
+    shared = jaccard * (size_a + size_b) / (1 + jaccard)
+    return shared / size_a
+
+
+class BoilerplateFilter:
+    """
+    Removes text that repeats across pages before it reaches a prompt:
+
+    - "--- Page N ---" markers;
+    - running headers/footers, page numbers and slide-template lines: edge
+      lines already seen on most earlier kept pages (page counters match
+      whatever their number);
+    - near-duplicate pages: a page whose shingles (MinHash estimate, taken
+      before headers are stripped) are mostly contained in a neighbouring
+      page is dropped in favour of the more complete one, so slide
+      build-ups collapse into the final slide.
+
+    Pages are processed in one pass with one page held back, so the filter
+    works on a stream: feeding a text whole or page by page gives the same
+    result. `report` counts what was removed.
+
+        f = BoilerplateFilter(model)
+        cleaned = [page for page in f.filter(pieces)]
+        f.report["tokens_saved"]
+    """
+
+    def __init__(self, model: str = ""):
+        self.model = model
+        self.report = {"pages": 0, "lines_removed": 0, "pages_dropped": 0, "tokens_saved": 0}
+        self._edge_counts = {}      # edge-line signature -> kept pages it appeared on
+        self._kept = 0
+        self._held = None           # (text, minhash, edge signatures) of the last page, not yet emitted
+        self._recent = deque(maxlen=NEAR_DUPLICATE_WINDOW)
+
+    def filter(self, pieces: Iterable[str]) -> Iterator[str]:
+        """Yield cleaned pages of `pieces` (each piece may hold any number of pages)."""
+        for piece in pieces:
+            yield from self.feed(piece)
+        yield from self.finish()
+
+    def feed(self, piece: str) -> list[str]:
+        ready = []
+        bounds = [m.start() for m in _MARKER_SPLIT.finditer(piece)]
+        if not bounds or bounds[0] > 0:
+            bounds.insert(0, 0)
+        pages = [piece[start:end].strip("\n") for start, end in zip(bounds, bounds[1:] + [len(piece)])]
+        for page in pages:
+            marker = _MARKER_SPLIT.match(page)
+            ready.extend(self._add_page(page[marker.end():] if marker else page))
+        self._count_saved(pages, ready)
+        return ready
+
+    def finish(self) -> list[str]:
+        ready = [self._emit(self._held)] if self._held is not None else []
+        self._held = None
+        self._count_saved([], ready)
+        return ready
+
+    def _count_saved(self, received: list[str], emitted: list[str]) -> None:
+        self.report["tokens_saved"] += (
+            sum(count_tokens_batch(received, self.model)) - sum(count_tokens_batch(emitted, self.model))
+        )
+
+    def _strip_edges(self, page: str) -> tuple[str, set]:
+        """The page without known boilerplate edge lines, and its edge-line signatures."""
+        lines = page.split("\n")
+        edges = set(range(min(EDGE_LINES, len(lines)))) | set(range(max(0, len(lines) - EDGE_LINES), len(lines)))
+        keep, signatures = [], set()
+        for i, line in enumerate(lines):
+            if i in edges and line.strip():
+                signature = _line_signature(line)
+                signatures.add(signature)
+                count = self._edge_counts.get(signature, 0)
+                if count >= BOILERPLATE_MIN_PAGES and count >= BOILERPLATE_PAGE_RATIO * self._kept:
+                    self.report["lines_removed"] += 1
+                    continue
+            keep.append(line)
+        return "\n".join(keep).strip("\n"), signatures
+
+    def _emit(self, held) -> str:
+        # Only kept pages count towards boilerplate, so dropped build-up
+        # slides don't get the surviving slide's title stripped
+        text, minhash, signatures = held
+        for signature in signatures:
+            self._edge_counts[signature] = self._edge_counts.get(signature, 0) + 1
+        self._kept += 1
+        self._recent.append(minhash)
+        return text
+
+    def _add_page(self, page: str) -> list[str]:
+        self.report["pages"] += 1
+        text, signatures = self._strip_edges(page.strip("\n"))
+        if not text.strip():
+            return []
+        current = (text, _minhash(page), signatures)
+        ready = []
+        if self._held is not None:
+            held = self._held
+            if held[1] is not None and current[1] is not None:
+                if _containment(held[1], current[1]) >= NEAR_DUPLICATE_CONTAINMENT:
+                    # The new page repeats and extends the held one (a build-up)
+                    self.report["pages_dropped"] += 1
+                    self._held = current
+                    return ready
+                if _containment(current[1], held[1]) >= NEAR_DUPLICATE_CONTAINMENT:
+                    self.report["pages_dropped"] += 1
+                    return ready
+            ready.append(self._emit(held))
+        if current[1] is not None and any(
+            earlier is not None and _containment(current[1], earlier) >= NEAR_DUPLICATE_CONTAINMENT
+            for earlier in self._recent
+        ):
+            self.report["pages_dropped"] += 1
+            self._held = None
+            return ready
+        self._held = current
+        return ready
+
+
+def remove_boilerplate(text: str, model: str = "") -> tuple[str, dict]:
+    """
+    Strip page markers, running headers/footers and near-duplicate pages
+    from extracted text (see BoilerplateFilter). Returns the cleaned text
+    and a report with the tokens saved. Text without page markers is
+    returned unchanged.
+    """
+    if not _MARKER_SPLIT.search(text):
+        return text, {"pages": 1, "lines_removed": 0, "pages_dropped": 0, "tokens_saved": 0}
+    with span("extract.clean") as current:
+        cleaner = BoilerplateFilter(model)
+        cleaned = "\n\n".join(cleaner.filter([text]))
+        current.set(**cleaner.report)
+    # Never hand an empty prompt on: if everything looked repeated, keep the original
+    return (cleaned, cleaner.report) if cleaned.strip() else (text, {**cleaner.report, "tokens_saved": 0})
+
+
+# Boundary strength before a unit: chunks prefer to end before the strongest one
+BREAK_SENTENCE, BREAK_LINE, BREAK_PARAGRAPH, BREAK_HEADING, BREAK_PAGE = range(5)
+# Units measured per tokenizer call
+UNIT_BATCH = 512
+
+_PARAGRAPH_BREAK = re.compile(r"\n[ \t\r\f\v]*\n\s*")
+_LINE = re.compile(r"[^\n]+")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+_WORD_SPAN = re.compile(r"\S+")
+_PAGE_LINE = re.compile(r"--- Page \d+ ---$")
+_HEADING_LINE = re.compile(
+    r"#{1,6}\s|(?:chapter|section|unit|part|lecture|module|topic)\s+\w+|\d+(?:\.\d+)*\.?\s+[A-Z]",
+    re.IGNORECASE,
+)
+_BULLET_LINE = re.compile(r"(?:[-*•▪◦]|\d+[.)]|[a-z][.)])\s")
+
+
+def _line_break(line: str) -> int:
+    """Boundary strength before a line that starts a new block (-1 = continues the block)."""
+    if _PAGE_LINE.match(line):
+        return BREAK_PAGE
+    if len(line) <= 80 and not line.endswith((".", ",", ";", ":")) and (
+        _HEADING_LINE.match(line) or (line.isupper() and sum(c.isalpha() for c in line) >= 3)
+    ):
+        return BREAK_HEADING
+    if _BULLET_LINE.match(line):
+        return BREAK_LINE
+    return -1
+
+
+def _segment(text: str, base: int = 0, first_break: int = BREAK_SENTENCE) -> Iterator[tuple[int, int, int]]:
+    """
+    Split `text` into units as (start, end, break) with offsets relative to
+    `base`. A unit is a sentence, or a whole page-marker / heading line;
+    `break` is the strength of the boundary just before it. Lines that are
+    neither headings nor bullets continue the sentence above them (PDF text
+    is hard-wrapped).
+    """
+    pending = first_break
+    position = 0
+    for separator in [*_PARAGRAPH_BREAK.finditer(text), None]:
+        end = separator.start() if separator else len(text)
+        block_start, block_break = None, pending
+        for line_match in _LINE.finditer(text, position, end):
+            line = line_match.group().strip()
+            if not line:
+                continue
+            line_break = _line_break(line)
+            if line_break < 0 and block_start is not None:
+                continue
+            if block_start is not None:
+                yield from _sentences(text, block_start, line_match.start(), base, block_break)
+                block_break = max(line_break, BREAK_LINE)
+            elif line_break >= 0:
+                block_break = max(block_break, line_break)
+            if line_break >= BREAK_HEADING:
+                # Headings and page markers are units of their own
+                yield from _sentences(text, line_match.start(), line_match.end(), base, block_break, split=False)
+                block_start, block_break = None, BREAK_LINE
+            else:
+                block_start = line_match.start()
+        if block_start is not None:
+            yield from _sentences(text, block_start, end, base, block_break)
+        pending = BREAK_PARAGRAPH
+        position = separator.end() if separator else end
+
+
+def _sentences(text: str, start: int, end: int, base: int, first_break: int, split: bool = True):
+    """Trimmed sentence units of text[start:end]."""
+    bounds = [start]
+    if split:
+        bounds += [m.end() for m in _SENTENCE_END.finditer(text, start, end)]
+    bounds.append(end)
+    brk = first_break
+    for a, b in zip(bounds, bounds[1:]):
+        while a < b and text[a].isspace():
+            a += 1
+        while b > a and text[b - 1].isspace():
+            b -= 1
+        if a < b:
+            yield base + a, base + b, brk
+            brk = BREAK_SENTENCE
+
+
+def _measure(units, text_of, model: str, limit: int) -> Iterator[tuple[int, int, int, int, int]]:
+    """
+    Add token counts (and a content hash) to units, in batches. Units over
+    `limit` tokens are split between words so every unit fits a chunk.
+    """
+    units = iter(units)
+    while True:
+        batch = [unit for _, unit in zip(range(UNIT_BATCH), units)]
+        if not batch:
+            return
+        texts = [text_of(start, end) for start, end, _ in batch]
+        for (start, end, brk), unit_text, tokens in zip(batch, texts, count_tokens_batch(texts, model)):
+            if tokens <= limit:
+                yield start, end, brk, tokens, zlib.crc32(unit_text.encode("utf-8"))
+                continue
+            words = list(_WORD_SPAN.finditer(unit_text))
+            # Leading space matches how words are tokenized mid-sentence
+            word_tokens = count_tokens_batch([" " + w.group() for w in words], model)
+            piece_start, used = 0, 0
+            for i, (word, count) in enumerate(zip(words, word_tokens)):
+                if used and used + count > limit:
+                    piece_end = words[i - 1].end()
+                    piece = unit_text[words[piece_start].start():piece_end]
+                    yield (start + words[piece_start].start(), start + piece_end,
+                           brk if piece_start == 0 else BREAK_SENTENCE, used, zlib.crc32(piece.encode("utf-8")))
+                    piece_start, used = i, 0
+                used += count
+            piece = unit_text[words[piece_start].start():]
+            yield (start + words[piece_start].start(), end,
+                   brk if piece_start == 0 else BREAK_SENTENCE, used, zlib.crc32(piece.encode("utf-8")))
+
+
+def _pack(units, max_tokens: int, overlap: int, content_defined: bool) -> Iterator[tuple[int, int, int]]:
+    """
+    Greedily pack measured units into chunks, yielding (start, end,
+    next_start) spans. When a chunk is full it ends before the strongest
+    boundary in its second half (page > heading > paragraph > line >
+    sentence), and the next chunk repeats up to `overlap` tokens of whole
+    units from its end.
+
+    With content_defined=True a chunk may also end early after a unit whose
+    hash hits a fixed pattern (more likely the more tokens it holds), so
+    boundaries depend on nearby text rather than on position.
+    """
+    body_max = max_tokens - overlap
+    min_tokens = body_max // 4
+    # Aim for chunks of about half the budget on average
+    gap = max(1.0, body_max / 2 - min_tokens)
+
+    current = []       # units of the chunk being built; the first `lead` are overlap
+    lead, used, lead_tokens = 0, 0, 0
+
+    def cut(at: int):
+        nonlocal current, lead, used, lead_tokens
+        emitted, kept = current[:at], current[at:]
+        carried, carried_tokens = len(emitted), 0
+        while carried > 0 and carried_tokens + emitted[carried - 1][3] <= overlap:
+            carried -= 1
+            carried_tokens += emitted[carried][3]
+        # Never carry the whole chunk: the next one must move forward
+        carried = max(carried, 1)
+        carried_tokens = sum(unit[3] for unit in emitted[carried:])
+        current = emitted[carried:] + kept
+        lead, lead_tokens = len(emitted) - carried, carried_tokens
+        used = sum(unit[3] for unit in current)
+        return emitted[0][0], emitted[-1][1], current[0][0] if current else None
+
+    for unit in units:
+        tokens = unit[3]
+        while len(current) > lead and used + tokens > max_tokens:
+            fill = (max_tokens - lead_tokens) // 2
+            best, best_at, body = -1, len(current), 0
+            for at in range(lead, len(current)):
+                body += current[at][3]
+                strength = current[at + 1][2] if at + 1 < len(current) else unit[2]
+                if body >= fill and strength >= best:
+                    best, best_at = strength, at + 1
+            yield cut(best_at)
+        current.append(unit)
+        used += tokens
+        if (content_defined and used - lead_tokens >= min_tokens
+                and unit[4] / 2 ** 32 < 1 - math.exp(-tokens / gap)):
+            yield cut(len(current))
+    if len(current) > lead:
+        yield current[0][0], current[-1][1], None
+
+
+def chunk_spans(
+    text: str,
+    max_tokens: int = 3000,
+    overlap: int = 200,
+    model: str = "",
+    content_defined: bool = False,
+) -> list[tuple[int, int]]:
+    """
+    Chunk boundaries as (start, end) offsets into `text`, computed in one
+    pass without copying the text: `text[start:end]` is the chunk. See
+    chunk_text() for the sizing and boundary rules.
+    """
+    _check_overlap(max_tokens, overlap)
+    units = _measure(_segment(text), lambda start, end: text[start:end], model, max_tokens - overlap)
+    return [(start, end) for start, end, _ in _pack(units, max_tokens, overlap, content_defined)]
+
+
+def _check_overlap(max_tokens: int, overlap: int) -> None:
+    if overlap < 0:
+        raise ValueError("overlap must not be negative.")
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens.")
+
+
+def iter_chunks(
+    pieces: Iterable[str],
+    max_tokens: int = 3000,
+    overlap: int = 200,
+    model: str = "",
+    content_defined: bool = True,
+) -> Iterator[str]:
+    """
+    Streaming chunker: consumes text pieces (e.g. pages as they are
+    extracted) and yields each chunk as soon as it is cut. Pieces are
+    treated as paragraphs of "\n\n".join(pieces), so the chunks equal
+    chunk_text() of the joined text with the same settings; only the text
+    of the chunk being built is kept.
+    """
+    _check_overlap(max_tokens, overlap)
+    buffer, base = "", 0
+
+    def units():
+        nonlocal buffer
+        offset = 0
+        for number, piece in enumerate(pieces):
+            if number:
+                buffer += "\n\n"
+                offset += 2
+            start = offset
+            buffer += piece
+            offset += len(piece)
+            # Measured per piece so a chunk can be cut as soon as its page arrives
+            yield from _measure(
+                _segment(piece, start, BREAK_PARAGRAPH if number else BREAK_SENTENCE),
+                lambda a, b, start=start, piece=piece: piece[a - start:b - start],
+                model,
+                max_tokens - overlap,
+            )
+
+    for start, end, next_start in _pack(units(), max_tokens, overlap, content_defined):
+        yield buffer[start - base:end - base]
+        if next_start is not None:
+            buffer, base = buffer[next_start - base:], next_start
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int = 3000,
+    overlap: int = 200,
+    model: str = "",
+    content_defined: bool = False,
+) -> list[str]:
+    """
+    Split text into chunks of at most max_tokens model tokens, with up to
+    `overlap` tokens of whole sentences repeated between neighbours for
+    context continuity. Chunks end on sentence boundaries, preferring page
+    markers, headings and paragraph breaks; only a sentence longer than a
+    chunk is split (between words, never inside one).
+
+    With content_defined=True, boundaries depend on the surrounding text
+    rather than on position, so editing one part of a document leaves the
+    other chunks unchanged (useful for reusing per-chunk results).
+    """
+    return [text[start:end] for start, end in chunk_spans(text, max_tokens, overlap, model, content_defined)]
@@ -29,6 +29,9 @@ Structure your response with:
 # NOTE SUMMARIZER
 # ─────────────────────────────────────────────
 
+# Bump when the summarizer prompts change so memoized chunk summaries are not reused
+SUMMARY_PROMPT_VERSION = 1
+
 SUMMARIZER_SYSTEM = """You are an expert academic assistant that creates clear, concise summaries.
 You identify the most important concepts, definitions, and relationships in study material.
 Your summaries are structured, scannable, and study-friendly."""
@@ -50,8 +53,10 @@ Also include at the end:
 - **Study Tips**: 2-3 tips for mastering this material"""
 
 
-def summarizer_chunk_prompt(chunk: str, chunk_num: int, total: int) -> str:
-    return f"""Summarize the key points from this section (part {chunk_num} of {total}) of a study document.
+def summarizer_chunk_prompt(chunk: str, chunk_num: int, total: int = None) -> str:
+    # `total` is unknown while a document is still being extracted
+    part = f"part {chunk_num} of {total}" if total else f"part {chunk_num}"
+    return f"""Summarize the key points from this section ({part}) of a study document.
 Be concise. Focus on facts, definitions, and concepts.
 
 SECTION:
@@ -74,6 +79,19 @@ Final summary should include:
 - Study Tips"""
 
 
+def combine_summaries_prompt(partial_summaries: list[str], first_section: int) -> str:
+    """Intermediate merge step for very long documents (the final merge comes later)."""
+    last_section = first_section + len(partial_summaries) - 1
+    combined = "\n\n---\n\n".join(
+        [f"Section {first_section + i} Summary:\n{s}" for i, s in enumerate(partial_summaries)]
+    )
+    return f"""Below are summaries of consecutive sections ({first_section}-{last_section}) of a long study document.
+Combine them into one concise summary of this part of the document, in order.
+Keep every key fact, definition, and concept; drop repetition. Do not add a glossary or study tips.
+
+{combined}"""
+
+
 # ─────────────────────────────────────────────
 # QUIZ GENERATOR
 # ─────────────────────────────────────────────
@@ -82,7 +100,7 @@ QUIZ_SYSTEM = """You are an expert educator who creates high-quality assessment
 You MUST return ONLY valid JSON — no explanations, no markdown fences, no extra text.
 The JSON must exactly match the requested format."""
 
-def quiz_user_prompt(topic_or_notes: str, num_questions: int, quiz_type: str) -> str:
+def quiz_user_prompt(topic_or_notes: str, num_questions: int, quiz_type: str, exclude: list[str] = ()) -> str:
     if quiz_type == "MCQ":
         format_desc = """[
   {
@@ -113,7 +131,15 @@ Rules:
 - Questions must be clear and unambiguous
 - For MCQ, make all 4 options plausible
 - Cover different aspects of the content
-- Return ONLY the JSON array, nothing else"""
+- Return ONLY the JSON array, nothing else""" + _exclude_rule(exclude)
+
+
+def _exclude_rule(items: list[str], noun: str = "questions") -> str:
+    """Extra rule listing what the quiz or deck already has (top-up requests)."""
+    if not items:
+        return ""
+    listed = "\n".join(f"  - {item}" for item in items)
+    return f"\n- Do NOT repeat or rephrase any of these existing {noun}:\n{listed}"
 
 
 # ─────────────────────────────────────────────
@@ -124,7 +150,7 @@ FLASHCARD_SYSTEM = """You are an expert at creating study flashcards.
 You MUST return ONLY valid JSON — no markdown, no extra text.
 Create flashcards that are clear, concise, and memorable."""
 
-def flashcard_user_prompt(topic_or_notes: str, num_cards: int) -> str:
+def flashcard_user_prompt(topic_or_notes: str, num_cards: int, exclude: list[str] = ()) -> str:
     return f"""Create exactly {num_cards} flashcards based on the following content.
 
 CONTENT:
@@ -143,7 +169,7 @@ Rules:
 - Front side should be a term, concept, or question
 - Back side should be a concise definition or answer (max 2-3 sentences)
 - Cover the most important concepts
-- Return ONLY the JSON array, nothing else"""
+- Return ONLY the JSON array, nothing else""" + _exclude_rule(exclude, "cards (fronts)")
 
 
 # ─────────────────────────────────────────────
@@ -0,0 +1,261 @@
+"""
+Utility: Client-side rate limiting and retry policy for LLM requests.
+
+A RateLimiter holds two token buckets (requests/minute and tokens/minute).
+Callers reserve capacity before each request and wait their turn instead of
+firing into a 429. Provider rate-limit headers keep the buckets honest, and
+retryable failures are retried with jittered exponential backoff
+(see utils.router, which runs the retry loop).
+"""
+
+import asyncio
+import email.utils
+import random
+import re
+import threading
+import time
+
+
+# HTTP status codes worth retrying (timeouts, conflicts, rate limits, server errors)
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Continuous-refill token bucket sized per minute.
+    A capacity of 0 disables the bucket until the provider reports its limit
+    (x-ratelimit-limit-*), which then sizes it. That limit's window is read
+    off the reset header (Groq's request limit is per day, not per minute).
+
+    Reservations may drive the level negative; each caller is told how long
+    to wait for its share, which queues requests in arrival order instead
+    of rejecting them.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._from_headers = self.capacity <= 0  # sized by the provider, not by config
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` from the bucket and return seconds to wait before using it."""
+        if self.capacity <= 0:
+            return 0.0
+        # A single request larger than the whole bucket would wait forever
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._level -= amount
+            if self._level >= 0:
+                return 0.0
+            return -self._level / self.rate
+
+    def adjust(self, delta: float) -> None:
+        """Charge (positive) or refund (negative) tokens after the fact."""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._level = min(self.capacity, self._level - delta)
+
+    def observe(self, remaining: float, reset_seconds: float, limit: float = None) -> None:
+        """
+        Clamp the bucket to what the provider says is left. If the provider
+        reports less than we think we have, the remaining deficit refills
+        over `reset_seconds`. Without a configured budget, `limit` sizes the
+        bucket once its window can be told from the headers.
+        """
+        with self._lock:
+            window = _limit_window(limit, remaining, reset_seconds) if self._from_headers else None
+            if window:
+                if self.capacity <= 0:
+                    self._level = float(limit)
+                    self._updated = time.monotonic()
+                self.capacity, self.rate = float(limit), limit / window
+            if self.capacity <= 0 or remaining is None:
+                return
+            self._refill(time.monotonic())
+            if remaining < self._level:
+                self._level = remaining
+                if reset_seconds and remaining <= 0:
+                    # Provider is exhausted until reset: push the level down so we wait it out
+                    self._level = min(self._level, -reset_seconds * self.rate)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets for one provider.
+
+    Args:
+        rpm: Requests per minute (0 = unlimited)
+        tpm: Tokens per minute, prompt + completion (0 = unlimited)
+    """
+
+    def __init__(self, rpm: float = 0, tpm: float = 0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> float:
+        """Reserve one request plus `tokens`; return seconds to wait."""
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        with self._lock:
+            pause = self._paused_until - time.monotonic()
+        return max(wait, pause, 0.0)
+
+    def acquire(self, tokens: int) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: int) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller for `seconds` (e.g. after a 429 with retry-after)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def record_usage(self, estimated: int, actual: int) -> None:
+        """Correct the token bucket once the real usage is known."""
+        if actual:
+            self.tokens.adjust(actual - estimated)
+
+    def update_from_headers(self, headers) -> None:
+        """
+        Sync bucket levels with x-ratelimit-limit-* / -remaining-* / -reset-*
+        headers, and hold every caller until the reset once a quota is used up.
+        """
+        if not headers:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            remaining = _to_float(headers.get(f"x-ratelimit-remaining-{kind}"))
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            bucket.observe(remaining, reset, _to_float(headers.get(f"x-ratelimit-limit-{kind}")))
+            if remaining is not None and remaining <= 0 and reset:
+                self.pause(reset)
+
+
+def _limit_window(limit, remaining, reset_seconds):
+    """
+    Seconds over which a header-reported limit refills. The reset header is
+    the time until the used part (limit - remaining) is back, so the whole
+    limit takes reset * limit / used. None until something has been used.
+    """
+    if not limit or limit <= 0 or remaining is None or not reset_seconds or remaining >= limit:
+        return None
+    # Providers do not use windows under a minute; shorter estimates are rounding
+    return max(60.0, reset_seconds * limit / (limit - max(remaining, 0)))
+
+
+# ─────────────────────────────────────────────
+# ERROR CLASSIFICATION
+# ─────────────────────────────────────────────
+
+def _status_code(exc: Exception):
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status
+
+
+def _headers(exc: Exception):
+    return getattr(getattr(exc, "response", None), "headers", None)
+
+
+def is_retryable(exc: Exception) -> bool:
+    """True for rate limits, server errors, timeouts and dropped connections."""
+    status = _status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    name = type(exc).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def retry_after(exc: Exception):
+    """
+    Seconds the provider asked us to wait, from retry-after-ms, retry-after
+    (seconds or HTTP date) or the x-ratelimit-reset-* headers. None if absent.
+    """
+    headers = _headers(exc)
+    if not headers:
+        return None
+
+    ms = _to_float(headers.get("retry-after-ms"))
+    if ms is not None:
+        return ms / 1000.0
+
+    value = headers.get("retry-after")
+    if value:
+        seconds = _to_float(value)
+        if seconds is not None:
+            return seconds
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return max(0.0, when.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    resets = [
+        parse_duration(headers.get("x-ratelimit-reset-requests")),
+        parse_duration(headers.get("x-ratelimit-reset-tokens")),
+    ]
+    resets = [r for r in resets if r]
+    return max(resets) if resets else None
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Full-jitter exponential backoff for the given 0-based attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_rate_limited(exc: Exception) -> bool:
+    return _status_code(exc) == 429
+
+
+def retry_delay(exc: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying after `exc` on the given 0-based attempt."""
+    hinted = retry_after(exc)
+    jittered = backoff_delay(attempt)
+    # Honour the provider's hint, plus a little jitter so waiters don't stampede
+    return hinted + jittered * 0.1 if hinted is not None else jittered
+
+
+# ─────────────────────────────────────────────
+# HEADER PARSING
+# ─────────────────────────────────────────────
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value):
+    """Parse provider reset durations like "1m30.5s", "250ms" or "2" into seconds."""
+    if not value:
+        return None
+    value = str(value).strip()
+    seconds = _to_float(value)
+    if seconds is not None:
+        return seconds
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNIT_SECONDS[unit] for n, unit in parts)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,368 @@
+"""
+Utility: Latency-aware routing across OpenAI-compatible backends.
+
+Each Backend keeps a rolling window of latencies and errors. The Router
+sends every call to the fastest healthy backend, retries retryable
+failures (failing over when another backend is available), and can hedge:
+if the first attempt is slower than a chosen latency percentile, a
+duplicate is fired at the next-best backend and whichever answers first wins.
+Streaming calls are measured and hedged on time-to-open (until the response
+headers arrive), kept in a separate window from full completions.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import telemetry
+from utils.rate_limit import RateLimiter, is_rate_limited, is_retryable, retry_delay
+
+
+# Samples needed before a backend's latency percentiles are trusted
+MIN_SAMPLES = 5
+# Consecutive failures that take a backend out of rotation, and for how long
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30.0
+
+
+class LatencyStats:
+    """Rolling latency / error window for one backend."""
+
+    def __init__(self, window: int = 100):
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)   # True = success
+        self._consecutive_failures = 0
+        self._last_failure = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float = None) -> None:
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            self._last_failure = time.monotonic()
+
+    @property
+    def samples(self) -> int:
+        return len(self._latencies)
+
+    def percentile(self, pct: float):
+        """Nearest-rank latency percentile in seconds, or None with too few samples."""
+        with self._lock:
+            values = sorted(self._latencies)
+        if len(values) < MIN_SAMPLES:
+            return None
+        index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+        return values[index]
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            outcomes = list(self._outcomes)
+        return outcomes.count(False) / len(outcomes) if outcomes else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        with self._lock:
+            if self._consecutive_failures < FAILURE_THRESHOLD:
+                return True
+            return time.monotonic() - self._last_failure > COOLDOWN_SECONDS
+
+
+class Backend:
+    """
+    One OpenAI-compatible endpoint.
+
+    Args:
+        name: Label used in stats and logs
+        api_key: API key for this endpoint
+        model: Model name to request from this endpoint
+        provider: "openai" (any OpenAI-compatible server) or "groq" (Groq SDK)
+        base_url: Optional endpoint override
+        rpm, tpm: Rate-limit budgets for this endpoint (0 = headers only)
+    """
+
+    def __init__(self, name, api_key, model, provider="openai", base_url=None, rpm=0, tpm=0):
+        self.name = name
+        self.api_key = api_key
+        self.model = model
+        self.provider = provider
+        self.base_url = base_url
+        self.tpm = float(tpm)   # as configured; headers may resize the limiter's bucket
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.stats = LatencyStats()
+        self.open_stats = LatencyStats()   # time until a stream's headers arrive
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()   # event loop -> client
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._build(use_async=False)
+            return self._client
+
+    def async_client(self):
+        """Async HTTP clients are bound to their event loop, so keep one per loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = self._build(use_async=True)
+                self._async_clients[loop] = client
+            return client
+
+    def _build(self, use_async: bool):
+        if not self.api_key:
+            raise ValueError("API key not found. Check your .env file.")
+
+        # Retries are handled by the Router, so the SDK's own are turned off
+        kwargs = {"api_key": self.api_key, "max_retries": 0}
+        if self.base_url:
+            kwargs["base_url"] = self.base_url
+
+        if self.provider == "groq":
+            from groq import Groq, AsyncGroq
+            return AsyncGroq(**kwargs) if use_async else Groq(**kwargs)
+
+        from openai import OpenAI, AsyncOpenAI
+        return AsyncOpenAI(**kwargs) if use_async else OpenAI(**kwargs)
+
+    def latency(self, stream: bool = False) -> LatencyStats:
+        """Latency window for full completions, or for stream opens."""
+        return self.open_stats if stream else self.stats
+
+    def describe(self) -> dict:
+        p50, p95 = self.stats.percentile(50), self.stats.percentile(95)
+        open_p50 = self.open_stats.percentile(50)
+        return {
+            "name": self.name,
+            "model": self.model,
+            "healthy": self.stats.healthy,
+            "samples": self.stats.samples,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "open_p50_ms": round(open_p50 * 1000) if open_p50 is not None else None,
+            "error_rate": round(self.stats.error_rate, 3),
+        }
+
+
+class Router:
+    """
+    Route calls across `backends`.
+
+    Args:
+        backends: Candidate Backend objects, in preference order
+        hedge_percentile: Fire a hedged duplicate once the first attempt
+            exceeds this latency percentile of its backend, counted from when its
+            rate limiter lets it through (None = never hedge; needs two backends)
+        max_retries: Retries for retryable failures
+    """
+
+    def __init__(self, backends: list, hedge_percentile: float = None, max_retries: int = 5):
+        if not backends:
+            raise ValueError("At least one LLM backend must be configured.")
+        self.backends = list(backends)
+        self.hedge_percentile = hedge_percentile
+        self.max_retries = max_retries
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def rank(self, stream: bool = False) -> list:
+        """
+        Backends ordered best-first: healthy before unhealthy, then backends
+        still gathering samples (so they get measured), then lowest p50
+        (time-to-open for streams) weighted by recent error rate.
+        """
+        def score(item):
+            index, backend = item
+            p50 = backend.latency(stream).percentile(50)
+            weighted = 0.0 if p50 is None else p50 * (1 + 4 * backend.stats.error_rate)
+            return (not backend.stats.healthy, weighted, index)
+
+        return [b for _, b in sorted(enumerate(self.backends), key=score)]
+
+    def stats(self) -> list[dict]:
+        return [b.describe() for b in self.backends]
+
+    # ── Sync path ──
+
+    def call(self, send, tokens: int, stream: bool = False):
+        """
+        Run `send(backend)` on the best backend with retries and optional hedging.
+        For streaming calls `send` returns once the stream is open: that
+        time-to-open is what is measured and hedged, and a losing duplicate
+        stream is closed.
+        """
+        for attempt in range(self.max_retries + 1):
+            ranked = self.rank(stream)
+            primary = ranked[0]
+            try:
+                if self.hedge_percentile and len(ranked) > 1:
+                    return self._hedged(send, primary, ranked[1], tokens, stream)
+                return self._send(send, primary, tokens, stream)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_retryable(exc):
+                    raise
+                self._record_retry(primary)
+                # Fail over right away if another backend is now preferred
+                if self.rank(stream)[0] is primary:
+                    time.sleep(retry_delay(exc, attempt))
+
+    def _send(self, send, backend, tokens, stream=False, acquired=False):
+        if not acquired:
+            backend.limiter.acquire(tokens)
+        start = time.monotonic()
+        try:
+            response = send(backend)
+        except Exception as exc:
+            self._record_failure(backend, exc)
+            raise
+        self._record_success(backend, time.monotonic() - start, stream)
+        return response
+
+    def _hedged(self, send, primary, secondary, tokens, stream=False):
+        delay = primary.latency(stream).percentile(self.hedge_percentile)
+        if delay is None:
+            return self._send(send, primary, tokens, stream)
+
+        # Wait for the rate limiter first: time spent queued there is not slowness
+        primary.limiter.acquire(tokens)
+        pool = self._get_pool()
+        ctx = contextvars.copy_context()
+        first = pool.submit(ctx.run, self._send, send, primary, tokens, stream, True)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        telemetry.set_attributes(hedged=True)
+        ctx = contextvars.copy_context()
+        pending = {first, pool.submit(ctx.run, self._send, send, secondary, tokens, stream)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The loser keeps running in the pool; its latency still gets recorded
+                    for loser in (pending | done) - {future}:
+                        if stream:
+                            loser.add_done_callback(_close_stream)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+            return self._pool
+
+    # ── Async path ──
+
+    async def acall(self, send, tokens: int, stream: bool = False):
+        """Async version of call(); `send(backend)` must return an awaitable."""
+        for attempt in range(self.max_retries + 1):
+            ranked = self.rank(stream)
+            primary = ranked[0]
+            try:
+                if self.hedge_percentile and len(ranked) > 1:
+                    return await self._ahedged(send, primary, ranked[1], tokens, stream)
+                return await self._asend(send, primary, tokens, stream)
+            except Exception as exc:
+                if attempt >= self.max_retries or not is_retryable(exc):
+                    raise
+                self._record_retry(primary)
+                if self.rank(stream)[0] is primary:
+                    await asyncio.sleep(retry_delay(exc, attempt))
+
+    async def _asend(self, send, backend, tokens, stream=False, acquired=False):
+        if not acquired:
+            await backend.limiter.aacquire(tokens)
+        start = time.monotonic()
+        try:
+            response = await send(backend)
+        except Exception as exc:
+            self._record_failure(backend, exc)
+            raise
+        self._record_success(backend, time.monotonic() - start, stream)
+        return response
+
+    async def _ahedged(self, send, primary, secondary, tokens, stream=False):
+        delay = primary.latency(stream).percentile(self.hedge_percentile)
+        if delay is None:
+            return await self._asend(send, primary, tokens, stream)
+
+        # Wait for the rate limiter first: time spent queued there is not slowness
+        await primary.limiter.aacquire(tokens)
+        first = asyncio.ensure_future(self._asend(send, primary, tokens, stream, True))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            telemetry.set_attributes(hedged=True)
+            pending.add(asyncio.ensure_future(self._asend(send, secondary, tokens, stream)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        # A duplicate stream that opened at the same moment is closed
+                        for loser in done - {task}:
+                            if stream and loser.exception() is None:
+                                await _aclose_stream(loser.result())
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # ── Shared ──
+
+    def _record_success(self, backend, latency, stream):
+        if stream:
+            backend.open_stats.record_success(latency)
+            backend.stats.record_success()  # counts toward the error rate only
+        else:
+            backend.stats.record_success(latency)
+
+    def _record_retry(self, backend):
+        telemetry.incr_attribute("retries")
+        telemetry.LLM_RETRIES.inc(backend=backend.name)
+
+    def _record_failure(self, backend, exc):
+        if not is_retryable(exc):
+            return  # bad requests say nothing about the backend's health
+        backend.stats.record_failure()
+        if is_rate_limited(exc):
+            # Hold this backend's other callers until the provider's window resets
+            backend.limiter.pause(retry_delay(exc, 0))
+
+
+def _close_stream(future) -> None:
+    """Done-callback closing the losing stream of a hedged open once it arrives."""
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), "close", None)
+        if close:
+            close()
+
+
+async def _aclose_stream(response) -> None:
+    close = getattr(response, "close", None)
+    if close:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
@@ -0,0 +1,376 @@
+"""
+Utility: Offline OpenAI-compatible stub server for load tests and benchmarks.
+
+Serves POST /v1/chat/completions (streaming and non-streaming) with
+configurable latency, generation speed and error/429 injection, and returns
+valid canned JSON for quiz and flashcard prompts so the whole app works
+end-to-end without a provider.
+
+Run it:
+    python -m utils.stub_llm --port 8765 --latency lognormal:-0.7,0.5 --tokens-per-sec 80
+
+Point the app at it (any API key works):
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub streamlit run app.py
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.prompts import FLASHCARD_SYSTEM, QUIZ_SYSTEM
+from utils.rate_limit import TokenBucket
+from utils.tokens import count_tokens
+
+
+_WORDS = (
+    "the cell membrane regulates transport of molecules energy is stored as ATP "
+    "photosynthesis converts light into chemical energy students should review key "
+    "definitions and examples mitochondria produce energy through respiration enzymes "
+    "lower activation energy structure determines function in biology and chemistry"
+).split()
+_VOCABULARY = sorted(set(_WORDS))
+
+
+class StubConfig:
+    """
+    Behaviour knobs for the stub server.
+
+    Args:
+        latency: Time-to-first-token distribution, e.g. "fixed:0.3",
+            "uniform:0.2,1.5", "normal:0.8,0.2" or "lognormal:-0.7,0.5" (seconds)
+        tokens_per_sec: Generation speed after the first token (0 = instant)
+        completion_tokens: Length of free-text replies, in words
+        error_rate: Probability of a 500 response
+        rate_limit_rate: Probability of a 429 response
+        rpm: Enforce a real requests-per-minute limit with 429s (0 = off)
+        retry_after: Seconds advertised in retry-after on 429s
+        seed: Seed for latency/error sampling (replies are seeded by prompt)
+    """
+
+    def __init__(
+        self,
+        latency: str = "fixed:0.2",
+        tokens_per_sec: float = 0,
+        completion_tokens: int = 200,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        rpm: float = 0,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        self.latency = _parse_distribution(latency)
+        self.tokens_per_sec = tokens_per_sec
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm_bucket = TokenBucket(rpm)
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency(self._rng))
+
+    def roll(self, probability: float) -> bool:
+        with self._lock:
+            return self._rng.random() < probability
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+
+def _parse_distribution(spec: str):
+    kind, _, args = spec.partition(":")
+    params = [float(x) for x in args.split(",") if x.strip()]
+    if kind == "fixed":
+        return lambda rng: params[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda rng: rng.gauss(params[0], params[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(params[0], params[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+# ─────────────────────────────────────────────
+# CANNED REPLIES
+# ─────────────────────────────────────────────
+
+def _requested_count(prompt: str, default: int) -> int:
+    match = re.search(r"exactly (\d+)", prompt)
+    return int(match.group(1)) if match else default
+
+
+def _phrases(rng: random.Random, size: int):
+    """
+    Endless phrases of `size` distinct words; no word repeats until the
+    vocabulary is used up, so canned questions are not near-duplicates
+    (core.quiz_gen drops those and asks again).
+    """
+    while True:
+        words = list(_VOCABULARY)
+        rng.shuffle(words)
+        for start in range(0, len(words) - size + 1, size):
+            yield " ".join(words[start:start + size])
+
+
+def _quiz_json(prompt: str, rng: random.Random) -> str:
+    count = _requested_count(prompt, 5)
+    true_false = re.search(r"exactly \d+ True/False", prompt) is not None
+    topics, answers = _phrases(rng, 5), _phrases(rng, 2)
+    questions = []
+    for _ in range(count):
+        topic = next(topics)
+        if true_false:
+            questions.append({
+                "question": f"{topic.capitalize()}.",
+                "answer": rng.choice(["True", "False"]),
+                "explanation": f"The notes discuss {topic}.",
+            })
+        else:
+            options = [f"{letter}) {next(answers)}" for letter in "ABCD"]
+            questions.append({
+                "question": f"What links {topic}?",
+                "options": options,
+                "answer": rng.choice(options),
+                "explanation": f"Because of how {topic} works.",
+            })
+    return json.dumps(questions, indent=2)
+
+
+def _flashcard_json(prompt: str, rng: random.Random) -> str:
+    count = _requested_count(prompt, 10)
+    cards = [
+        {
+            "front": f"{rng.choice(_WORDS).title()} #{i + 1}",
+            "back": " ".join(rng.choice(_WORDS) for _ in range(12)).capitalize() + ".",
+            "category": rng.choice(["Biology", "Chemistry", "General"]),
+        }
+        for i in range(count)
+    ]
+    return json.dumps(cards, indent=2)
+
+
+def _free_text(length: int, rng: random.Random) -> str:
+    words = [rng.choice(_WORDS) for _ in range(length)]
+    lines = []
+    for start in range(0, len(words), 15):
+        lines.append("- " + " ".join(words[start:start + 15]).capitalize() + ".")
+    return "## Summary\n\n" + "\n".join(lines)
+
+
+def build_reply(messages: list[dict], config: StubConfig) -> str:
+    """Deterministic reply for `messages` (same prompt → same reply)."""
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+    rng = random.Random(int(digest[:16], 16))
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    prompt = messages[-1].get("content") or "" if messages else ""
+
+    if system == QUIZ_SYSTEM:
+        return _quiz_json(prompt, rng)
+    if system == FLASHCARD_SYSTEM:
+        return _flashcard_json(prompt, rng)
+    return _free_text(config.completion_tokens, rng)
+
+
+def _split_tokens(text: str) -> list[str]:
+    """Rough token-sized pieces (words with their trailing whitespace)."""
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+# ─────────────────────────────────────────────
+# HTTP SERVER
+# ─────────────────────────────────────────────
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = None   # set by make_server()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "stub-model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        config = self.config
+        config.count("requests")
+
+        wait = config.rpm_bucket.reserve(1)
+        if wait > 0:
+            config.rpm_bucket.adjust(-1)   # rejected requests don't consume budget
+            self._rate_limited(wait)
+            return
+        if config.roll(config.rate_limit_rate):
+            self._rate_limited(config.retry_after)
+            return
+        if config.roll(config.error_rate):
+            config.count("errors")
+            self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+
+        messages = body.get("messages") or []
+        model = body.get("model") or "stub-model"
+        reply = build_reply(messages, config)
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in messages)
+        pieces = _split_tokens(reply)
+
+        time.sleep(config.sample_latency())
+        if body.get("stream"):
+            self._stream(model, pieces)
+        else:
+            if config.tokens_per_sec > 0:
+                time.sleep(len(pieces) / config.tokens_per_sec)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(pieces),
+                    "total_tokens": prompt_tokens + len(pieces),
+                },
+            })
+
+    def _rate_limited(self, retry_after: float):
+        self.config.count("rate_limited")
+        self._send_json(
+            429,
+            {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_exceeded"}},
+            headers={
+                "retry-after": str(max(1, math.ceil(retry_after))),
+                "retry-after-ms": str(int(retry_after * 1000)),
+                "x-ratelimit-remaining-requests": "0",
+            },
+        )
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # client gave up (a hedged or cancelled request)
+
+    def _stream(self, model: str, pieces: list[str]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # No Content-Length for SSE: close the connection to mark the end
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        delay = 1.0 / self.config.tokens_per_sec if self.config.tokens_per_sec > 0 else 0
+
+        def event(delta: dict, finish_reason=None):
+            payload = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for piece in pieces:
+                event({"content": piece})
+                if delay:
+                    time.sleep(delay)
+            event({}, finish_reason="stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass   # client stopped reading
+
+
+def make_server(config: StubConfig, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+    """Build (but don't start) a stub server; call serve_forever() on the result."""
+    handler = type("StubHandler", (_Handler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(config: StubConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Start a stub server on a daemon thread (port 0 = pick a free port). Returns (server, base_url)."""
+    server = make_server(config or StubConfig(), host, port)
+    threading.Thread(target=server.serve_forever, name="stub-llm", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible stub LLM server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="fixed:0.2", help='e.g. "uniform:0.2,1.5", "lognormal:-0.7,0.5"')
+    parser.add_argument("--tokens-per-sec", type=float, default=0)
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--rpm", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        rpm=args.rpm,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    server = make_server(config, args.host, args.port)
+    print(f"Stub LLM listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(config.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+Utility: Lightweight tracing and metrics for the LLM pipelines.
+
+    with span("summarize", feature="summarizer"):
+        with span("summarize.map", chunk=3):
+            ...
+        set_attributes(chunks=10)
+
+Every finished span is written as one JSON line to the trace log (if
+LLM_TRACE_LOG is set) and feeds latency histograms that can be scraped in
+Prometheus text format (LLM_METRICS_PORT) or dumped to a file
+(LLM_METRICS_FILE). Spans nest across threads started with
+contextvars.copy_context().
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+logger = logging.getLogger("study_buddy.telemetry")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# ─────────────────────────────────────────────
+# METRICS
+# ─────────────────────────────────────────────
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, (('le', str(bound)),))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+SPAN_DURATION = Histogram(
+    "study_buddy_span_duration_seconds",
+    "Duration of traced pipeline steps, by span name and feature.",
+)
+LLM_DURATION = Histogram(
+    "study_buddy_llm_request_duration_seconds",
+    "End-to-end chat_completion latency, by feature, model and cache status.",
+)
+LLM_TOKENS = Counter(
+    "study_buddy_llm_tokens_total",
+    "Tokens reported by the provider, by feature and kind (prompt/completion).",
+)
+LLM_RETRIES = Counter(
+    "study_buddy_llm_retries_total",
+    "Retried LLM attempts, by backend.",
+)
+SPAN_ERRORS = Counter(
+    "study_buddy_span_errors_total",
+    "Spans that ended with an exception, by span name and feature.",
+)
+
+METRICS = [SPAN_DURATION, LLM_DURATION, LLM_TOKENS, LLM_RETRIES, SPAN_ERRORS]
+
+
+def render_prometheus() -> str:
+    """All metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(path: str) -> None:
+    """Atomically write the current metrics to `path`."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+# ─────────────────────────────────────────────
+# SPANS
+# ─────────────────────────────────────────────
+
+class Span:
+    def __init__(self, name: str, parent, attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        # Children inherit the feature label so LLM calls are attributed correctly
+        self.feature = attributes.pop("feature", None) or (parent.feature if parent else None)
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def set(self, **attributes) -> None:
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def incr(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            attributes = dict(self.attributes)
+        record = {
+            "ts": round(time.time(), 3),
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "feature": self.feature,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+            "status": "error" if self.error else "ok",
+        }
+        if self.error:
+            record["error"] = self.error
+        record.update(attributes)
+        return record
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Trace the enclosed block as a child of the current span."""
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except GeneratorExit:
+        # A streaming consumer stopped early — not an error
+        current.set(closed_early=True)
+        raise
+    except BaseException as exc:
+        current.error = f"{type(exc).__name__}: {exc}"[:500]
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # A generator-wrapped span closed from another context (e.g. at GC)
+            pass
+        _finish(current)
+
+
+def _finish(current: Span) -> None:
+    SPAN_DURATION.observe(current.duration, span=current.name, feature=current.feature)
+    if current.error:
+        SPAN_ERRORS.inc(span=current.name, feature=current.feature)
+    if logger.handlers:
+        logger.info(json.dumps(current.to_dict(), ensure_ascii=False, default=str))
+
+
+def record_llm_call(current: Span) -> None:
+    """Feed a finished LLM span into the per-feature latency and token metrics."""
+    attrs = current.attributes
+    LLM_DURATION.observe(
+        current.duration,
+        feature=current.feature,
+        model=attrs.get("model"),
+        cache=attrs.get("cache"),
+        status="error" if current.error else "ok",
+    )
+    for kind in ("prompt", "completion"):
+        tokens = attrs.get(f"{kind}_tokens")
+        if tokens:
+            LLM_TOKENS.inc(tokens, feature=current.feature, kind=kind)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_feature():
+    current = _current_span.get()
+    return current.feature if current else None
+
+
+def set_attributes(**attributes) -> None:
+    """Attach attributes to the current span (no-op outside a span)."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def incr_attribute(key: str, amount: int = 1) -> None:
+    current = _current_span.get()
+    if current is not None:
+        current.incr(key, amount)
+
+
+# ─────────────────────────────────────────────
+# EXPORT SETUP
+# ─────────────────────────────────────────────
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """Serve /metrics on a daemon thread. Returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def _metrics_file_loop(path: str, interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            write_metrics_file(path)
+        except OSError:
+            pass
+
+
+def configure_from_env() -> None:
+    """
+    Set up exporters once per process from environment variables:
+        LLM_TRACE_LOG      JSON-lines span log file ("-" = stderr)
+        LLM_METRICS_PORT   serve Prometheus metrics on this port
+        LLM_METRICS_FILE   rewrite Prometheus metrics to this file every 15s
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        _configured = True
+
+    trace_log = os.getenv("LLM_TRACE_LOG", "").strip()
+    if trace_log:
+        handler = logging.StreamHandler() if trace_log == "-" else logging.FileHandler(trace_log, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+
+    port = os.getenv("LLM_METRICS_PORT", "").strip()
+    if port:
+        try:
+            start_metrics_server(int(port))
+        except OSError as e:
+            # Another process (e.g. a second Streamlit worker) already owns the port
+            logger.warning(f"Metrics server not started on port {port}: {e}")
+
+    metrics_file = os.getenv("LLM_METRICS_FILE", "").strip()
+    if metrics_file:
+        threading.Thread(
+            target=_metrics_file_loop, args=(metrics_file, 15.0), name="metrics-file", daemon=True
+        ).start()
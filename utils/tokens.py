@@ -0,0 +1,115 @@
+"""
+Utility: Token counting and budgeting.
+
+Uses tiktoken when it is installed and its encodings are available offline
+(encoders are cached per model); otherwise falls back to a fast, slightly
+conservative approximation so budgets never undercount badly.
+"""
+
+import math
+from functools import lru_cache
+
+
+# Context windows (prompt + completion) for models we expect to see.
+# Matched by prefix, longest first; unknown models get DEFAULT_CONTEXT_WINDOW.
+CONTEXT_WINDOWS = {
+    "llama-3.3-70b": 131072,
+    "llama-3.1-8b": 131072,
+    "llama3-70b": 8192,
+    "llama3-8b": 8192,
+    "mixtral-8x7b": 32768,
+    "gemma2-9b": 8192,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Per-message framing overhead of the chat format (role markers etc.)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: str):
+    """Return a tiktoken encoding for `model`, or None if unavailable."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass  # not an OpenAI model (e.g. Llama on Groq) — cl100k is a close proxy
+    except Exception:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # Encoding files not cached and no network
+        return None
+
+
+def _approx_tokens(text: str) -> int:
+    """~4 chars or ~0.75 words per token, whichever is larger."""
+    if not text:
+        return 0
+    return math.ceil(max(len(text) / 4, len(text.split()) * 4 / 3))
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    """Number of model tokens in `text`."""
+    if not text:
+        return 0
+    encoding = _get_encoding(model or "")
+    if encoding is None:
+        return _approx_tokens(text)
+    return len(encoding.encode_ordinary(text))
+
+
+def count_tokens_batch(texts: list[str], model: str = "") -> list[int]:
+    """count_tokens() for many short strings at once (e.g. every word of a document)."""
+    encoding = _get_encoding(model or "")
+    if encoding is None:
+        return [_approx_tokens(t) for t in texts]
+    return [len(ids) for ids in encoding.encode_ordinary_batch(texts)]
+
+
+def count_message_tokens(messages: list[dict], model: str = "") -> int:
+    """Prompt tokens for a chat `messages` list, including framing overhead."""
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(message.get("content") or "", model)
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "") -> str:
+    """Return the longest prefix of `text` that fits in `max_tokens`."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model or "")
+    if encoding is not None:
+        ids = encoding.encode_ordinary(text)
+        if len(ids) <= max_tokens:
+            return text
+        return encoding.decode(ids[:max_tokens])
+
+    if _approx_tokens(text) <= max_tokens:
+        return text
+    # Start from a character estimate, then shrink until it fits
+    cut = text[: max_tokens * 4]
+    while cut and _approx_tokens(cut) > max_tokens:
+        cut = cut[: int(len(cut) * 0.9)]
+    space = cut.rfind(" ")
+    return cut[:space] if space > len(cut) // 2 else cut
+
+
+def get_context_window(model: str) -> int:
+    """Total context window (prompt + completion) for `model`."""
+    name = (model or "").lower()
+    for prefix in sorted(CONTEXT_WINDOWS, key=len, reverse=True):
+        if name.startswith(prefix):
+            return CONTEXT_WINDOWS[prefix]
+    return DEFAULT_CONTEXT_WINDOW